@@ -0,0 +1,79 @@
+import argparse
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import torch
+from importlib_resources import files
+
+from yolov7.models.yolo import Model
+from yolov7.utils.torch_utils import CompiledModel, TracedModel
+
+parser = argparse.ArgumentParser(description='Compare eager, traced and torch.compile()d forward passes of the '
+                                             'fused cfg/deploy models up to Detect, weights are random')
+parser.add_argument('--cfgs', nargs='+', default=['yolov7-tiny.yaml', 'yolov7.yaml'],
+                    help='cfg/deploy file names or paths')
+parser.add_argument('--img-size', type=int, default=320)
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4])
+parser.add_argument('--runs', type=int, default=10)
+parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+parser.add_argument('--compile-mode', default=None, help="torch.compile mode, e.g. 'max-autotune-no-cudagraphs'")
+parser.add_argument('--onnx', action='store_true', help='add ONNX Runtime, which also runs Detect')
+opt = parser.parse_args()
+
+if opt.threads:
+    torch.set_num_threads(opt.threads)
+
+
+def timed(fn, x):
+    times = []
+    for _ in range(opt.runs):
+        t = perf_counter()
+        fn(x)
+        times.append(perf_counter() - t)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+def backends(model):
+    # (name, seconds to prepare incl. first call, callable), each callable runs the model up to Detect
+    # (onnxruntime includes Detect, its decode is a small part of the forward pass)
+    model.traced = True
+    x = torch.zeros((1, 3, opt.img_size, opt.img_size))
+    yield 'eager', 0., model
+    t = perf_counter()
+    traced = TracedModel(model, 'cpu', opt.img_size).model
+    traced(x)
+    yield 'trace', perf_counter() - t, traced
+    t = perf_counter()
+    compiled = CompiledModel(model, mode=opt.compile_mode)
+    for bs in sorted({1, max(opt.batch_sizes)}):  # batch 1 and larger batches compile separately
+        compiled(x.expand(bs, -1, -1, -1).contiguous())
+    yield 'compile', perf_counter() - t, compiled
+    if opt.onnx:
+        from yolov7.utils.onnx_utils import OnnxModel, export_onnx
+        with tempfile.TemporaryDirectory() as d:
+            t = perf_counter()
+            export_onnx(model, model.names, Path(d) / 'model.onnx', img_size=opt.img_size)
+            session = OnnxModel(Path(d) / 'model.onnx', threads=opt.threads)
+            session(x)
+            yield 'onnxruntime', perf_counter() - t, session
+
+
+print(f'CPU, {torch.get_num_threads()} threads, {opt.img_size}x{opt.img_size}, median of {opt.runs} runs, ms per batch')
+with torch.no_grad():
+    for cfg in opt.cfgs:
+        path = Path(cfg) if Path(cfg).is_file() else files('yolov7').joinpath(f'cfg/deploy/{cfg}')
+        model = Model(path).fuse().eval()
+        print(f'\n{Path(path).name}')
+        print('%-12s%12s' % ('backend', 'prepare s') + ''.join('%12s' % f'batch {bs}' for bs in opt.batch_sizes)
+              + '%12s' % 'speedup')
+        eager = None
+        for name, prepare, fn in backends(model):
+            ms = [timed(fn, torch.rand((bs, 3, opt.img_size, opt.img_size))) for bs in opt.batch_sizes]
+            eager = eager or ms
+            print('%-12s%12.1f' % (name, prepare) + ''.join('%12.1f' % t for t in ms)
+                  + '%11.2fx' % (sum(eager) / sum(ms)))
+        if hasattr(torch, '_dynamo'):
+            from torch._dynamo.utils import counters
+            print(f"compile graphs: {counters['stats']['unique_graphs']}")  # stays flat across batch sizes
+            counters.clear()
@@ -0,0 +1,45 @@
+import argparse
+import json
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description='Cold import wall time and RSS of yolov7 modules, each run in a fresh '
+                                             'interpreter')
+parser.add_argument('--modules', nargs='+', default=['torch', 'yolov7.yolov7'],
+                    help='modules to import, torch alone is the floor every module pays')
+parser.add_argument('--runs', type=int, default=5)
+parser.add_argument('--budget-ms', type=float, default=None, help='fail if the last module imports slower')
+parser.add_argument('--budget-mb', type=float, default=None, help='fail if the last module peaks above this RSS')
+opt = parser.parse_args()
+
+# the child reports its own import wall time and peak RSS, unaffected by interpreter startup
+child = '''
+import json, resource, sys, time
+t = time.perf_counter()
+__import__(sys.argv[1])
+t = time.perf_counter() - t
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 ** 2)
+heavy = ['requests', 'PIL', 'matplotlib', 'torchvision', 'thop', 'yolov7.utils.plots', 'yolov7.utils.loss']
+print(json.dumps({'ms': t * 1000, 'mb': rss, 'loaded': [m for m in heavy if m in sys.modules]}))
+'''
+
+
+def measure(module):
+    results = []
+    for _ in range(opt.runs):
+        out = subprocess.run([sys.executable, '-c', child, module], capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    median = lambda k: sorted(r[k] for r in results)[len(results) // 2]
+    return median('ms'), median('mb'), results[-1]['loaded']
+
+
+print('%-24s%12s%12s  %s' % ('module', 'median ms', 'peak MB', 'optional modules loaded'))
+ms = mb = None
+for module in opt.modules:
+    ms, mb, loaded = measure(module)
+    print('%-24s%12.0f%12.0f  %s' % (module, ms, mb, ', '.join(loaded) or '-'))
+
+over = [f'{ms:.0f} ms > {opt.budget_ms:.0f} ms'] if opt.budget_ms is not None and ms > opt.budget_ms else []
+over += [f'{mb:.0f} MB > {opt.budget_mb:.0f} MB'] if opt.budget_mb is not None and mb > opt.budget_mb else []
+if over:
+    sys.exit(f'{opt.modules[-1]} over budget: {", ".join(over)}')
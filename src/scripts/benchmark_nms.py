@@ -0,0 +1,87 @@
+import argparse
+from time import perf_counter
+
+import torch
+
+from yolov7.utils.general import batched_non_max_suppression, non_max_suppression
+from yolov7.utils.nms import engines
+from yolov7.utils.quantize import detection_delta
+
+parser = argparse.ArgumentParser(description='Compare NMS engines on synthetic head outputs')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--batch-size', type=int, default=16)
+parser.add_argument('--anchors', type=int, default=25200, help='predictions per image, 25200 for yolov7 at 640')
+parser.add_argument('--nc', type=int, default=80)
+parser.add_argument('--conf-thresh', type=float, default=0.25)
+parser.add_argument('--iou-thresh', type=float, default=0.45)
+parser.add_argument('--runs', type=int, default=10)
+opt = parser.parse_args()
+
+device = torch.device(opt.device)
+
+
+def synthetic(objects_per_image, boxes_per_object):
+    # (bs, anchors, 5 + nc) head output with clusters of overlapping boxes around each object, low objectness elsewhere.
+    # The boxes of a cluster share their object's class, like real head output, so NMS has to suppress them.
+    g = torch.Generator().manual_seed(0)
+    bs, n, nc = opt.batch_size, opt.anchors, opt.nc
+    pred = torch.rand((bs, n, 5 + nc), generator=g)
+    pred[..., :2] *= 640  # xy
+    pred[..., 2:4] = pred[..., 2:4] * 100 + 4  # wh
+    pred[..., 4] *= 0.1  # background objectness
+    pred[..., 5:] *= 0.1  # background class scores, the planted class is the best one
+    k = min(objects_per_image * boxes_per_object, n)
+    for b in range(bs):
+        idx = torch.randperm(n, generator=g)[:k]
+        centers = torch.rand((objects_per_image, 2), generator=g) * 640
+        sizes = torch.rand((objects_per_image, 2), generator=g) * 150 + 10
+        obj = torch.arange(k) % objects_per_image
+        jitter = torch.randn((k, 4), generator=g) * 4
+        pred[b, idx, :2] = centers[obj] + jitter[:, :2]
+        pred[b, idx, 2:4] = sizes[obj] + jitter[:, 2:]
+        pred[b, idx, 4] = 0.5 + 0.5 * torch.rand(k, generator=g)
+        pred[b, idx, 5 + torch.randint(0, nc, (objects_per_image,), generator=g)[obj]] = 0.95
+    return pred.to(device)
+
+
+def timed(fn, pred):
+    times, out = [], None
+    for i in range(opt.runs + 1):
+        x = pred.clone()  # NMS scales the class scores in place
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        t = perf_counter()
+        out = fn(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if i:  # first run warms up
+            times.append(perf_counter() - t)
+    return sorted(times)[len(times) // 2] * 1000, out
+
+
+def recall(out, ref):
+    # fraction of the reference detections matched by a detection of the same class at IoU >= 0.5
+    rows = lambda dets: [(d[:, :4].cpu().numpy(), d[:, 4].cpu().numpy(), d[:, 5].cpu().numpy()) for d in dets]
+    return detection_delta(rows(ref), rows(out))['recall']
+
+
+def agreement(out, ref):
+    # fraction of the reference detections found identically
+    same = sum(len({tuple(r) for r in o.tolist()} & {tuple(r) for r in f.tolist()}) for o, f in zip(out, ref))
+    return same / max(sum(len(f) for f in ref), 1)
+
+
+for name, pred in [('sparse', synthetic(objects_per_image=5, boxes_per_object=10)),
+                   ('dense', synthetic(objects_per_image=50, boxes_per_object=20))]:
+    print(f'\n{name}: {opt.batch_size} images x {opt.anchors} predictions, '
+          f'{int((pred[..., 4] > opt.conf_thresh).sum())} candidates, {device}')
+    print('%-34s%12s%12s%12s%12s' % ('method', 'median ms', 'detections', 'recall', 'agreement'))
+    ms, ref = timed(lambda x: non_max_suppression(x, opt.conf_thresh, opt.iou_thresh, time_limit=None), pred)
+    print('%-34s%12.2f%12d%12.3f%12.3f' % ('per image loop, torchvision', ms, sum(map(len, ref)), 1, 1))
+    if max(map(len, ref)) >= 300:
+        print('the reference hits max_det (300) on some image, detection counts there are capped')
+    for engine in engines:
+        ms, out = timed(lambda x: batched_non_max_suppression(x, opt.conf_thresh, opt.iou_thresh, engine=engine),
+                        pred)
+        print('%-34s%12.2f%12d%12.3f%12.3f' % (f'batched, {engine}', ms, sum(map(len, out)), recall(out, ref),
+                                                agreement(out, ref)))
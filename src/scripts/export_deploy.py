@@ -0,0 +1,23 @@
+import argparse
+from time import perf_counter
+
+from yolov7.models.experimental import attempt_load_state_dict, export_deploy
+from yolov7.models.yolo import Model
+
+parser = argparse.ArgumentParser(description='Export state_dict weights to a deploy checkpoint that loads without '
+                                             'building and fusing the training graph')
+parser.add_argument('--weights', required=True, help='state_dict checkpoint with class_names')
+parser.add_argument('--cfg', required=True, help='model yaml the weights were trained with')
+parser.add_argument('--output', required=True, help='deploy checkpoint to write')
+opt = parser.parse_args()
+
+t = perf_counter()
+model, class_names = attempt_load_state_dict(Model(opt.cfg), opt.weights, map_location='cpu')
+build = perf_counter() - t
+export_deploy(model, class_names, opt.output)
+
+t = perf_counter()
+attempt_load_state_dict(None, opt.output, map_location='cpu', trusted=True)  # written above
+load = perf_counter() - t
+print(f'\n{opt.output}: {len(class_names)} classes, strides {model.stride.tolist()}')
+print(f'state_dict + cfg: {build * 1000:.0f} ms, deploy checkpoint: {load * 1000:.0f} ms')
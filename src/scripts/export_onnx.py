@@ -0,0 +1,19 @@
+import argparse
+
+from yolov7.models.experimental import attempt_load_state_dict
+from yolov7.utils.onnx_utils import export_onnx
+
+parser = argparse.ArgumentParser(description='Export weights to ONNX for YOLOv7(backend="onnxruntime")')
+parser.add_argument('--weights', required=True, help='state_dict or deploy checkpoint')
+parser.add_argument('--cfg', default=None, help='model yaml, not needed for deploy checkpoints')
+parser.add_argument('--trusted', action='store_true',
+                    help='allow checkpoints that need full unpickling, which can run code')
+parser.add_argument('--output', required=True, help='.onnx file to write')
+parser.add_argument('--img-size', type=int, default=640, help='example input size, the only one with --static')
+parser.add_argument('--static', action='store_true', help='fixed input height and width, the batch stays dynamic')
+parser.add_argument('--opset', type=int, default=12)
+opt = parser.parse_args()
+
+model, class_names = attempt_load_state_dict(opt.cfg, opt.weights, map_location='cpu', trusted=opt.trusted)
+export_onnx(model, class_names, opt.output, img_size=opt.img_size, dynamic=not opt.static, opset=opt.opset)
+print(f'\n{opt.output}: {len(class_names)} classes, {"static" if opt.static else "dynamic"} input size')
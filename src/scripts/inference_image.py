@@ -54,6 +54,7 @@ def initialize_yolov7_model(weights_path, config_path):
         max_batch_size=16,
         half=True,
         same_size=False,
+        bucket_shapes=True,  # mixed resolutions: batch by minimum-rectangle shape instead of padding to square
         conf_thresh=0.2,
         trace=False,
         cudnn_benchmark=False,
@@ -0,0 +1,57 @@
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+import cv2
+
+from yolov7.models.experimental import attempt_load_state_dict, export_deploy
+from yolov7.utils.quantize import detection_delta, quantize_model
+from yolov7.yolov7 import YOLOv7
+
+parser = argparse.ArgumentParser(description='Quantize a model to INT8 for CPU inference and report how its '
+                                             'detections differ from the fp32 model')
+parser.add_argument('--weights', required=True, help='state_dict or deploy checkpoint')
+parser.add_argument('--cfg', default=None, help='model yaml, not needed for deploy checkpoints')
+parser.add_argument('--trusted', action='store_true',
+                    help='allow checkpoints that need full unpickling, which can run code')
+parser.add_argument('--calib', required=True, help='folder of calibration images')
+parser.add_argument('--samples', default=None, help='folder of images for the accuracy report, default --calib')
+parser.add_argument('--output', required=True, help='quantized deploy checkpoint to write')
+parser.add_argument('--img-size', type=int, default=640)
+parser.add_argument('--num-calib', type=int, default=100, help='calibration images used at most')
+parser.add_argument('--qengine', default='x86', help="'x86' or 'fbgemm' for x86 CPUs, 'qnnpack' for ARM")
+parser.add_argument('--conf-thresh', type=float, default=0.25)
+opt = parser.parse_args()
+
+suffixes = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp'}
+
+
+def read(folder, limit=None):
+    paths = sorted(p for p in Path(folder).iterdir() if p.suffix.lower() in suffixes)[:limit]
+    if not paths:
+        raise ValueError(f'no images in {folder}')
+    return [cv2.imread(str(p)) for p in paths]  # BGR
+
+
+model, class_names = attempt_load_state_dict(opt.cfg, opt.weights, map_location='cpu', trusted=opt.trusted)
+t = perf_counter()
+quantized = quantize_model(model, read(opt.calib, opt.num_calib), img_size=opt.img_size, qengine=opt.qengine)
+print(f'calibrated and converted in {perf_counter() - t:.1f} s')
+export_deploy(quantized, class_names, opt.output)
+
+samples = read(opt.samples or opt.calib)
+results = {}
+for name, weights, trusted in [('fp32', opt.weights, opt.trusted), ('int8', opt.output, True)]:
+    detector = YOLOv7(weights=weights, cfg=opt.cfg, device='cpu', model_image_size=opt.img_size,
+                      conf_thresh=opt.conf_thresh, trace=False, same_size=False, trusted_weights=trusted)
+    detector.detect_batch(samples[:1])  # warm up at a real input shape
+    t = perf_counter()
+    results[name] = detector.detect_batch(samples)
+    print(f'{name}: {(perf_counter() - t) / len(samples) * 1000:.1f} ms per image, '
+          f'{results[name].total} detections')
+    detector.close()
+
+delta = detection_delta(results['fp32'], results['int8'])
+print(f"\nINT8 vs fp32 on {len(samples)} images: recall {delta['recall']:.3f}, precision {delta['precision']:.3f}, "
+      f"mean IoU {delta['mean_iou']:.3f}, mean score delta {delta['mean_score_delta']:.4f} "
+      f"({delta['matched']} of {delta['reference']} fp32 detections matched, {delta['detections']} int8)")
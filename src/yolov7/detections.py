@@ -0,0 +1,117 @@
+# Columnar detection results
+
+import numpy as np
+
+
+class DetectionBatch:
+    # Detections of a batch of images in contiguous arrays, image i owns rows offsets[i]:offsets[i+1].
+    # Indexing an image returns views into the arrays, the legacy tuple/dict formats are only built on request.
+    __slots__ = ('boxes', 'scores', 'class_ids', 'offsets', 'box_format', 'class_names')
+
+    def __init__(self, boxes, scores, class_ids, offsets, box_format='ltrb', class_names=None):
+        self.boxes = boxes  # ndarray(n, len(box_format)) int64
+        self.scores = scores  # ndarray(n,) float32
+        self.class_ids = class_ids  # ndarray(n,) int64, index into class_names
+        self.offsets = offsets  # ndarray(images + 1,) int64
+        self.box_format = box_format
+        self.class_names = class_names
+
+    @classmethod
+    def from_frames(cls, frames, box_format='ltrb', class_names=None):
+        # frames: iterable of per image (boxes, scores, class_ids) arrays, see YOLOv7.detect_iter(arrays=True)
+        frames = list(frames)
+        counts = [len(scores) for _, scores, _ in frames]
+        offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        if frames:
+            boxes, scores, class_ids = (np.concatenate(column) for column in zip(*frames))
+        else:
+            boxes = np.empty((0, len(box_format)), np.int64)
+            scores, class_ids = np.empty(0, np.float32), np.empty(0, np.int64)
+        return cls(boxes, scores, class_ids, offsets, box_format=box_format, class_names=class_names)
+
+    def __len__(self):
+        return len(self.offsets) - 1  # images
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        # int: (boxes, scores, class_ids) views of one image, slice: DetectionBatch view of consecutive images
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError('DetectionBatch only supports contiguous slices')
+            stop = max(start, stop)
+            lo, hi = self.offsets[start], self.offsets[stop]
+            return DetectionBatch(self.boxes[lo:hi], self.scores[lo:hi], self.class_ids[lo:hi],
+                                  self.offsets[start:stop + 1] - lo, box_format=self.box_format,
+                                  class_names=self.class_names)
+        n = len(self)
+        if not -n <= i < n:
+            raise IndexError(f'image index {i} out of range for {n} images')
+        i %= n
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return self.boxes[lo:hi], self.scores[lo:hi], self.class_ids[lo:hi]
+
+    def __repr__(self):
+        return f'DetectionBatch(images={len(self)}, detections={self.total}, box_format={self.box_format!r})'
+
+    @property
+    def total(self):
+        return len(self.scores)
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)  # detections per image
+
+    @property
+    def image_ids(self):
+        return np.repeat(np.arange(len(self)), self.counts)  # image index of every detection
+
+    @property
+    def labels(self):
+        return np.asarray(self.class_names, dtype=object)[self.class_ids]
+
+    def filter(self, mask):
+        # keep detections where mask (bool ndarray(n,)) is set, image boundaries are preserved
+        mask = np.asarray(mask, dtype=bool)
+        offsets = np.zeros_like(self.offsets)
+        np.cumsum(np.bincount(self.image_ids[mask], minlength=len(self)), out=offsets[1:])
+        return DetectionBatch(self.boxes[mask], self.scores[mask], self.class_ids[mask], offsets,
+                              box_format=self.box_format, class_names=self.class_names)
+
+    def select(self, classes=None, min_score=None):
+        # keep detections of the given class names and/or with score >= min_score
+        mask = np.ones(self.total, dtype=bool)
+        if classes is not None:
+            ids = [self.class_names.index(name) for name in classes]
+            mask &= np.isin(self.class_ids, ids)
+        if min_score is not None:
+            mask &= self.scores >= min_score
+        return self.filter(mask)
+
+    def to_arrays(self):
+        # plain dict of arrays, e.g. for np.savez
+        return {'boxes': self.boxes, 'scores': self.scores, 'class_ids': self.class_ids, 'offsets': self.offsets}
+
+    def to_tuples(self):
+        # legacy detect_get_box_in output: per image list of (box_infos, score, predicted_class)
+        class_names = self.class_names
+        boxes, scores, class_ids = self.boxes.tolist(), self.scores.tolist(), self.class_ids.tolist()
+        return [[(boxes[j], scores[j], class_names[class_ids[j]]) for j in range(lo, hi)]
+                for lo, hi in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
+
+    def to_dicts(self):
+        # legacy get_detections_dict output: per image list of dicts with keys label, confidence, t, l, b, r, w, h
+        missing = set('tlbrwh') - set(self.box_format)
+        if missing:
+            raise ValueError(f'box_format {self.box_format!r} lacks {"".join(sorted(missing))} for to_dicts()')
+        class_names = self.class_names
+        columns = {c: self.boxes[:, self.box_format.index(c)].tolist() for c in 'tlbrwh'}
+        scores, class_ids = self.scores.tolist(), self.class_ids.tolist()
+        return [[{'label': class_names[class_ids[j]], 'confidence': scores[j], 't': columns['t'][j],
+                  'l': columns['l'][j], 'b': columns['b'][j], 'r': columns['r'][j], 'w': columns['w'][j],
+                  'h': columns['h'][j]} for j in range(lo, hi)]
+                for lo, hi in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist())]
@@ -4,18 +4,17 @@ from pathlib import Path
 
 import numpy as np
 # import pandas as pd
-import requests
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from PIL import Image
-from torch.cuda import amp
 
 from yolov7.utils.datasets import letterbox
 from yolov7.utils.general import non_max_suppression, make_divisible, scale_coords, increment_path, xyxy2xywh
-from yolov7.utils.plots import color_list, plot_one_box
 from yolov7.utils.torch_utils import time_synchronized
 
+# requests, PIL, torch.cuda.amp and utils.plots (matplotlib) are imported by autoShape/Detections when used, headless
+# inference never needs them
+
 
 # ##### basic ####
 
@@ -885,6 +884,8 @@ class autoShape(nn.Module):
         #   numpy:           = np.zeros((640,1280,3))  # HWC
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
+        from PIL import Image
+        from torch.cuda import amp
 
         t = [time_synchronized()]
         p = next(self.model.parameters())  # for device and type
@@ -898,6 +899,8 @@ class autoShape(nn.Module):
         for i, im in enumerate(imgs):
             f = f'image{i}'  # filename
             if isinstance(im, str):  # filename or uri
+                if im.startswith('http'):
+                    import requests
                 im, f = np.asarray(Image.open(requests.get(im, stream=True).raw if im.startswith('http') else im)), im
             elif isinstance(im, Image.Image):  # PIL Image
                 im, f = np.asarray(im), getattr(im, 'filename', f) or f
@@ -950,6 +953,9 @@ class Detections:
         self.s = shape  # inference BCHW shape
 
     def display(self, pprint=False, show=False, save=False, render=False, save_dir=''):
+        from PIL import Image
+        from yolov7.utils.plots import color_list, plot_one_box
+
         colors = color_list()
         for i, (img, pred) in enumerate(zip(self.imgs, self.pred)):
             str = f'image {i + 1}/{len(self.pred)}: {img.shape[0]}x{img.shape[1]} '
@@ -1,3 +1,7 @@
+import inspect
+import pickle
+from copy import deepcopy
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -58,18 +62,85 @@ class Ensemble(nn.ModuleList):
         return y, None  # inference, train output
 
 
-def attempt_load_state_dict(models, weights, map_location=None):
+DEPLOY_FORMAT = 1  # layout version of deploy checkpoints, see export_deploy()
+
+
+def export_deploy(model, class_names, f):
+    # Saves a fused model as a self-describing deploy checkpoint: the inference graph itself plus strides, anchors and
+    # class names. attempt_load_state_dict() rebuilds it without parse_model(), the stride probing forward, bias init
+    # or fusion. The module is pickled, like upstream yolov7 checkpoints, so loading it needs trusted=True.
+    if getattr(model, 'input_folded', False) or getattr(model, 'class_ids', None) is not None:
+        raise ValueError('export the model before fold_input() or select_classes(), both are applied at load time')
+    model = deepcopy(model).float().cpu().eval()
+    model.traced = False
+    m = model.model[-1]  # Detect() module
+    if hasattr(m, 'decode_cache'):
+        m.decode_cache = {}  # grids are rebuilt on the target device
+    checkpoint = {'deploy': DEPLOY_FORMAT,
+                  'model': model,
+                  'class_names': list(class_names),
+                  'stride': m.stride.tolist(),
+                  'anchors': (m.anchors * m.stride.view(-1, 1, 1)).view(m.nl, -1).tolist(),  # pixels, like the yaml
+                  'yaml': model.yaml,
+                  'torch': torch.__version__}
+    torch.save(checkpoint, f)
+    return checkpoint
+
+
+def load_checkpoint(w, map_location=None, mmap=False, trusted=False):
+    # Checkpoints load with weights_only=True, which cannot run code. Deploy checkpoints (a pickled module) and
+    # state_dict checkpoints holding other objects (e.g. an argparse 'opt') need full unpickling, which runs whatever
+    # the file says, so they are only read with trusted=True.
+    # mmap: tensors are views into the memory-mapped file, processes loading the same file share its pages until they
+    # write to them. Needs the zipfile format torch.save() writes since torch 1.6, legacy files are read normally.
+    kwargs = {'mmap': True} if mmap else {}
+    safe = 'weights_only' in inspect.signature(torch.load).parameters  # torch>=1.13, older versions always unpickle
+    try:
+        try:
+            checkpoint = torch.load(w, map_location=map_location, **({'weights_only': True} if safe else {}), **kwargs)
+        except pickle.UnpicklingError:
+            if not trusted:
+                raise ValueError(f'{w} needs full unpickling, which can run code when loaded, pass trusted=True '
+                                 f'(YOLOv7 trusted_weights=True) only for files you trust') from None
+            checkpoint = torch.load(w, map_location=map_location, weights_only=False, **kwargs)
+            if not isinstance(checkpoint, dict) or not ('state_dict' in checkpoint or 'deploy' in checkpoint):
+                raise
+    except RuntimeError as e:
+        if not mmap or '_use_new_zipfile_serialization' not in str(e):
+            raise
+        return load_checkpoint(w, map_location=map_location, trusted=trusted)
+    if isinstance(checkpoint, dict) and 'deploy' in checkpoint and not trusted:  # unpickled by torch<1.13
+        raise ValueError(f'{w} is a deploy checkpoint, pass trusted=True (YOLOv7 trusted_weights=True) to load it')
+    return checkpoint
+
+
+def attempt_load_state_dict(models, weights, map_location=None, fold_input=False, bgr=False, mmap=False,
+                            trusted=False):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
+    # models are Model()s or cfgs, a cfg is only built if its weights are a state_dict rather than a deploy checkpoint
+    # fold_input folds the 1/255 input scaling (and BGR->RGB swap if bgr) into each model's stem, see Model.fold_input()
+    # mmap keeps the weights in the memory-mapped checkpoint instead of copying them into the model, see load_checkpoint()
+    # trusted allows checkpoints that need full unpickling (deploy files, pickled extras), which can run code
+    from yolov7.models.yolo import Model  # yolo.py imports this module
+
     ensemble_model = Ensemble()
     models = models if isinstance(models, list) else [models]
     weights = weights if isinstance(weights, list) else [weights]
     class_names = []
     for i, w in enumerate(weights):
-        checkpoint = torch.load(w, map_location=map_location)
-        model = models[i]
-        model.fuse()
-        model.load_state_dict(checkpoint['state_dict'])
+        checkpoint = load_checkpoint(w, map_location=map_location, mmap=mmap, trusted=trusted)
+        if 'deploy' in checkpoint:  # fused inference graph, see export_deploy()
+            if checkpoint['deploy'] > DEPLOY_FORMAT:
+                raise ValueError(f'{w} is a deploy checkpoint v{checkpoint["deploy"]}, this version reads up to '
+                                 f'v{DEPLOY_FORMAT}')
+            model = checkpoint['model']
+        else:
+            model = models[i] if isinstance(models[i], nn.Module) else Model(models[i])
+            model.fuse()
+            model.load_state_dict(checkpoint['state_dict'], **({'assign': True} if mmap else {}))
         model.eval()
+        if fold_input:
+            model.fold_input(bgr=bgr)
         ensemble_model.append(model)
         class_names.append(checkpoint['class_names'])
 
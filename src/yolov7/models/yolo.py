@@ -1,4 +1,7 @@
+import io
 import logging
+import math
+import threading
 from copy import deepcopy
 from pathlib import Path
 
@@ -11,12 +14,72 @@ from yolov7.utils.autoanchor import check_anchor_order
 from yolov7.utils.general import make_divisible
 from yolov7.utils.torch_utils import time_synchronized, fuse_conv_and_bn, model_info, scale_img, initialize_weights, \
     copy_attr
-from yolov7.utils.loss import SigmoidBin
 
-try:
-    import thop  # for FLOPS computation
-except ImportError:
-    thop = None
+_decode_lock = threading.Lock()  # heads are shared by the threads running a model, see decode_grids()
+
+
+def decode_grids(m, i, ny, nx, dtype, device):
+    # (grid - 0.5) * stride and 4 * anchor_grid of level i, cached on the head per (level, ny, nx, dtype, device) for
+    # the decode_cache_size most recently used input shapes
+    key = (i, ny, nx, dtype, device)
+    with _decode_lock:
+        cache = m.decode_cache
+        grids = cache.pop(key, None)
+        if grids is None:
+            stride = float(m.stride[i])
+            offset = ((m._make_grid(nx, ny) - 0.5) * stride).to(device, dtype)  # shape(1,1,ny,nx,2)
+            anchor = (m.anchor_grid[i] * 4).to(device, dtype)  # shape(1,na,1,1,2)
+            grids = (offset, anchor, 2 * stride)
+        cache[key] = grids  # most recently used last
+        while len(cache) > getattr(m, 'decode_cache_size', 8) * m.nl:
+            del cache[next(iter(cache))]  # least recently used
+    return grids
+
+
+@torch.no_grad()  # inference output only, losses use the raw x
+def decode(m, x):
+    # sigmoid and xywh decode of all levels x[i](bs,na,ny,nx,no) straight into one (bs,sum(na*ny*nx),no) output,
+    # xy = (2 * sig - 0.5 + grid) * stride, wh = (2 * sig) ** 2 * anchor_grid
+    bs, no = x[0].shape[0], x[0].shape[-1]
+    out = torch.empty((bs, sum(xi.shape[1:4].numel() for xi in x), no), dtype=x[0].dtype, device=x[0].device)
+    start = 0
+    for i, xi in enumerate(x):
+        _, na, ny, nx, _ = xi.shape
+        offset, anchor, scale = decode_grids(m, i, ny, nx, xi.dtype, xi.device)
+        y = out[:, start:start + na * ny * nx].view(bs, na, ny, nx, no)
+        start += na * ny * nx
+        torch.sigmoid(xi, out=y)
+        xy, wh = y[..., 0:2], y[..., 2:4]
+        torch.add(offset, xy, alpha=scale, out=xy)  # xy
+        wh.mul_(wh).mul_(anchor)  # wh
+    return out
+
+
+@torch.no_grad()
+def decode_candidates(m, x, conf_thres):
+    # decode() for the anchors whose objectness can pass conf_thres only, compared on the logits before the sigmoid.
+    # Returns sparse candidates (rows(n,no), image index(n,), batch size), per image in the same order as decode().
+    if conf_thres <= 0:
+        thres = -math.inf
+    elif conf_thres >= 1:
+        thres = math.inf
+    else:
+        thres = math.log(conf_thres / (1 - conf_thres)) - 1e-2  # margin for rounding, NMS applies conf_thres exactly
+    rows, image_ids = [], []
+    for i, xi in enumerate(x):
+        _, na, ny, nx, _ = xi.shape
+        offset, anchor, scale = decode_grids(m, i, ny, nx, xi.dtype, xi.device)
+        b, a, gy, gx = (xi[..., 4] > thres).nonzero(as_tuple=True)
+        y = xi[b, a, gy, gx].sigmoid_()  # (n,no)
+        y[:, 0:2] = y[:, 0:2] * scale + offset[0, 0, gy, gx]  # xy
+        y[:, 2:4] = y[:, 2:4] ** 2 * anchor[0, a, 0, 0]  # wh
+        rows.append(y)
+        image_ids.append(b)
+    return torch.cat(rows), torch.cat(image_ids), x[0].shape[0]
+
+
+def _cat(z):
+    return z[0] if len(z) == 1 else torch.cat(z, 1)  # decode() already fills a single output
 
 
 class Detect(nn.Module):
@@ -25,6 +88,7 @@ class Detect(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    candidate_thresh = None  # inference: return sparse candidates with obj > candidate_thresh, see decode_candidates()
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(Detect, self).__init__()
@@ -37,6 +101,8 @@ class Detect(nn.Module):
         self.register_buffer('anchors', a)  # shape(nl,na,2)
         self.register_buffer('anchor_grid', a.clone().view(self.nl, 1, -1, 1, 1, 2))  # shape(nl,1,na,1,1,2)
         self.m = nn.ModuleList(nn.Conv2d(x, self.no * self.na, 1) for x in ch)  # output conv
+        self.decode_cache = {}  # (level, ny, nx, dtype, device): decode grids, see decode_grids()
+        self.decode_cache_size = 8  # input shapes whose grids are kept, the least recently used are dropped
 
     def forward(self, x):
         # x = x.copy()  # for profiling
@@ -47,31 +113,31 @@ class Detect(nn.Module):
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
-            if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+            if not self.training and torch.onnx.is_in_onnx_export():  # inference, traceable decode
+                self.grid[i] = self._make_grid(nx, ny).to(x[i].device)  # from the traced shape, keeps h, w dynamic
                 y = x[i].sigmoid()
-                if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                else:
-                    xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
-                    xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
-                    wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
-                    y = torch.cat((xy, wh, conf), 4)
+                xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
+                xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
+                wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
+                y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, -1, self.no))
 
+        if not self.training and not torch.onnx.is_in_onnx_export():  # inference
+            if self.candidate_thresh is not None:
+                return decode_candidates(self, x, self.candidate_thresh), x
+            z = [decode(self, x)]
+
         if self.training:
             out = x
         elif self.end2end:
-            out = torch.cat(z, 1)
+            out = _cat(z)
         elif self.include_nms:
             z = self.convert(z)
             out = (z, )
         elif self.concat:
-            out = torch.cat(z, 1)
+            out = _cat(z)
         else:
-            out = (torch.cat(z, 1), x)
+            out = (_cat(z), x)
 
         return out
 
@@ -99,6 +165,7 @@ class IDetect(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    candidate_thresh = None  # inference: return sparse candidates with obj > candidate_thresh, see decode_candidates()
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(IDetect, self).__init__()
@@ -114,10 +181,11 @@ class IDetect(nn.Module):
         
         self.ia = nn.ModuleList(ImplicitA(x) for x in ch)
         self.im = nn.ModuleList(ImplicitM(self.no * self.na) for _ in ch)
+        self.decode_cache = {}  # (level, ny, nx, dtype, device): decode grids, see decode_grids()
+        self.decode_cache_size = 8  # input shapes whose grids are kept, the least recently used are dropped
 
     def forward(self, x):
         # x = x.copy()  # for profiling
-        z = []  # inference output
         self.training |= self.export
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
@@ -125,16 +193,11 @@ class IDetect(nn.Module):
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
-            if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-
-                y = x[i].sigmoid()
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                z.append(y.view(bs, -1, self.no))
-
-        return x if self.training else (torch.cat(z, 1), x)
+        if self.training:
+            return x
+        if self.candidate_thresh is not None:
+            return decode_candidates(self, x, self.candidate_thresh), x
+        return decode(self, x), x
     
     def fuseforward(self, x):
         # x = x.copy()  # for profiling
@@ -145,32 +208,31 @@ class IDetect(nn.Module):
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
-            if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
-
+            if not self.training and torch.onnx.is_in_onnx_export():  # inference, traceable decode
+                self.grid[i] = self._make_grid(nx, ny).to(x[i].device)  # from the traced shape, keeps h, w dynamic
                 y = x[i].sigmoid()
-                if not torch.onnx.is_in_onnx_export():
-                    y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i]) * self.stride[i]  # xy
-                    y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                else:
-                    xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
-                    xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
-                    wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
-                    y = torch.cat((xy, wh, conf), 4)
+                xy, wh, conf = y.split((2, 2, self.nc + 1), 4)  # y.tensor_split((2, 4, 5), 4)  # torch 1.8.0
+                xy = xy * (2. * self.stride[i]) + (self.stride[i] * (self.grid[i] - 0.5))  # new xy
+                wh = wh ** 2 * (4 * self.anchor_grid[i].data)  # new wh
+                y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, -1, self.no))
 
+        if not self.training and not torch.onnx.is_in_onnx_export():  # inference
+            if self.candidate_thresh is not None:
+                return decode_candidates(self, x, self.candidate_thresh), x
+            z = [decode(self, x)]
+
         if self.training:
             out = x
         elif self.end2end:
-            out = torch.cat(z, 1)
+            out = _cat(z)
         elif self.include_nms:
             z = self.convert(z)
             out = (z, )
         elif self.concat:
-            out = torch.cat(z, 1)
+            out = _cat(z)
         else:
-            out = (torch.cat(z, 1), x)
+            out = (_cat(z), x)
 
         return out
     
@@ -438,6 +500,8 @@ class IBin(nn.Module):
         self.nc = nc  # number of classes
         self.bin_count = bin_count
 
+        from yolov7.utils.loss import SigmoidBin  # training code, only needed by this head
+
         self.w_bin_sigmoid = SigmoidBin(bin_count=self.bin_count, min=0.0, max=4.0)
         self.h_bin_sigmoid = SigmoidBin(bin_count=self.bin_count, min=0.0, max=4.0)
         # classes, x,y,obj
@@ -508,6 +572,8 @@ class Model(nn.Module):
     def __init__(self, cfg='yolor-csp-c.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super(Model, self).__init__()
         self.traced = False
+        self.input_folded = False  # takes raw 0-255 input, see fold_input()
+        self.class_ids = None  # original class of each head output class, see select_classes()
         if isinstance(cfg, dict):
             self.yaml = cfg  # model dict
         else:  # is *.yaml
@@ -611,6 +677,10 @@ class Model(nn.Module):
                     break
 
             if profile:
+                try:
+                    import thop  # for FLOPS computation
+                except ImportError:
+                    thop = None
                 c = isinstance(m, (Detect, IDetect, IAuxDetect, IBin))
                 o = thop.profile(m, inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 if thop else 0  # FLOPS
                 for _ in range(10):
@@ -708,6 +778,64 @@ class Model(nn.Module):
         self.info()
         return self
 
+    def fold_input(self, bgr=False, scale=1 / 255., check=True):  # fold input BGR->RGB swap and scaling into the stem
+        # The model then takes raw BGR (bgr=True) or RGB 0-255 input. Both ops are linear and zero padding is
+        # unaffected, so permuting and rescaling the first conv's input channels is exact up to rounding.
+        reorg = isinstance(self.model[0], ReOrg)  # ReOrg stems stack 4 pixel phases of the 3 input channels
+        if reorg and 0 in self.save:
+            raise ValueError('ReOrg output is reused by later layers, cannot fold the input into the stem')
+        n, phases = (2, 4) if reorg else (1, 1)  # stem layers, channel groups
+        m = self.model[n - 1]
+        conv = m.rbr_reparam if isinstance(m, RepConv) and m.deploy else getattr(m, 'conv', m)
+        if not isinstance(conv, nn.Conv2d) or conv.groups != 1 or conv.in_channels != 3 * phases:
+            raise ValueError(f'cannot fold the input into stem {m.type}')
+
+        stem = self.model[:n]
+        if check:
+            x = torch.randint(0, 256, (1, 3, 64, 64), device=conv.weight.device).to(conv.weight.dtype)
+            with torch.no_grad():
+                y = stem((x[:, [2, 1, 0]] if bgr else x) * scale)
+
+        perm = [3 * g + c for g in range(phases) for c in ((2, 1, 0) if bgr else (0, 1, 2))]
+        with torch.no_grad():
+            conv.weight.copy_(conv.weight[:, perm] * scale)
+        self.input_folded = True
+
+        if check:
+            with torch.no_grad():
+                if not torch.allclose(stem(x), y, rtol=1e-3, atol=1e-3):
+                    raise AssertionError('input folding changed the stem output')
+        return self
+
+    def select_classes(self, class_ids):  # slice the Detect() output convs down to box, obj and the given classes
+        # Output class j of the specialised head is class class_ids[j] of the original model, see self.class_ids
+        # Each box then takes its best class among class_ids, not its best class overall
+        m = self.model[-1]  # Detect() module
+        if not isinstance(m, (Detect, IDetect)):
+            raise ValueError(f'cannot select classes of a {type(m).__name__} head')
+        class_ids = [int(c) for c in class_ids]
+        if not class_ids or len(set(class_ids)) != len(class_ids) or not all(0 <= c < m.nc for c in class_ids):
+            raise ValueError(f'class ids must be unique and in [0, {m.nc}), got {class_ids}')
+        base = self.class_ids  # already specialised, class_ids index into the current subset
+
+        keep = [a * m.no + k for a in range(m.na) for k in list(range(5)) + [5 + c for c in class_ids]]
+        with torch.no_grad():
+            for i, conv in enumerate(m.m):
+                idx = torch.tensor(keep, device=conv.weight.device)
+                sliced = nn.Conv2d(conv.in_channels, len(keep), 1, bias=conv.bias is not None).to(conv.weight)
+                sliced.weight.copy_(conv.weight[idx])
+                if conv.bias is not None:
+                    sliced.bias.copy_(conv.bias[idx])
+                m.m[i] = sliced
+            if isinstance(m, IDetect):  # unfused forward scales by ImplicitM after the conv
+                for im in m.im:
+                    im.implicit = nn.Parameter(im.implicit[:, keep].clone())
+
+        m.nc = len(class_ids)
+        m.no = m.nc + 5
+        self.class_ids = [base[c] for c in class_ids] if base is not None else class_ids
+        return self
+
     def nms(self, mode=True):  # add or remove NMS module
         present = type(self.model[-1]) is NMS  # last layer is NMS
         if mode and not present:
@@ -732,6 +860,44 @@ class Model(nn.Module):
         model_info(self, verbose, img_size)
 
 
+class QuantizedModel(Model):
+    # Model whose layers up to Detect() run in INT8, Detect() and its decode stay float. Built from a fused Model by
+    # utils/quantize.py quantize_model(), CPU only. model[0] is the scripted quantized graph, model[-1] the Detect().
+    def __init__(self, model, backbone, qengine='x86'):
+        nn.Module.__init__(self)
+        self.traced = False
+        self.input_folded = model.input_folded
+        self.class_ids = model.class_ids
+        self.yaml, self.names, self.stride, self.save = model.yaml, model.names, model.stride, []
+        self.model = nn.ModuleList([backbone, model.model[-1]])
+        self.qengine = qengine  # torch.backends.quantized.engine the model was calibrated for
+
+    def forward_once(self, x, profile=False):
+        x = self.model[0](x)  # float input, float Detect() inputs
+        return x if self.traced else self.model[-1](x)
+
+    def __getstate__(self):  # the scripted graph pickles as a TorchScript archive
+        state = self.__dict__.copy()
+        state['_modules'] = state['_modules'].copy()
+        backbone, detect = state['_modules'].pop('model')
+        buffer = io.BytesIO()
+        torch.jit.save(backbone, buffer)
+        state['_modules']['model'] = nn.ModuleList([detect])
+        state['backbone_archive'] = buffer.getvalue()
+        return state
+
+    def __setstate__(self, state):
+        backbone = torch.jit.load(io.BytesIO(state.pop('backbone_archive')), map_location='cpu')
+        super(QuantizedModel, self).__setstate__(state)
+        self.model.insert(0, backbone)
+
+    def fuse(self):  # fused before quantizing
+        return self
+
+    def fold_input(self, bgr=False, scale=1 / 255., check=True):
+        raise ValueError('fold_input() before quantize_model(), the stem of a quantized model cannot change')
+
+
 def parse_model(d, ch):  # model_dict, input_channels(3)
     logger.info('\n%3s%18s%3s%10s  %-40s%-30s' % ('', 'from', 'n', 'params', 'module', 'arguments'))
     anchors, nc, gd, gw = d['anchors'], d['nc'], d['depth_multiple'], d['width_multiple']
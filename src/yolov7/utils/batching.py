@@ -0,0 +1,80 @@
+# Dynamic micro-batching of concurrent requests
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()  # shutdown marker
+
+
+class MicroBatcher:
+    # Collects items submitted from many threads and runs them through fn(key, items) -> results in batches.
+    # A batch is closed when it holds max_batch_size items or max_wait seconds after its first item arrived.
+    # Items are only batched with items of the same key (e.g. the same postprocessing arguments).
+
+    def __init__(self, fn, max_batch_size=4, max_wait=0.005):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item, key=None):
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('cannot submit to a closed MicroBatcher')
+            self._queue.put((key, item, future))
+        return future
+
+    def close(self):
+        # finishes everything already submitted, then stops the worker thread
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is _STOP:
+            return None, True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is _STOP:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            groups = {}
+            for key, item, future in batch or ():
+                if future.set_running_or_notify_cancel():  # skip requests cancelled while queued
+                    groups.setdefault(key, []).append((item, future))
+
+            for key, requests in groups.items():
+                items, futures = zip(*requests)
+                try:
+                    results = self.fn(key, list(items))
+                except BaseException as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                for future, result in zip(futures, results):
+                    future.set_result(result)
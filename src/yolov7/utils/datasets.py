@@ -4,9 +4,8 @@ import cv2
 import numpy as np
 
 
-def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    # Resize and pad image while meeting stride-multiple constraints
-    shape = img.shape[:2]  # current shape [height, width]
+def letterbox_params(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Letterbox geometry for an image of shape [height, width]: resized (w, h), ratio and (left, top, right, bottom) padding
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -29,9 +28,50 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     dw /= 2  # divide padding into 2 sides
     dh /= 2
 
-    if shape[::-1] != new_unpad:  # resize
-        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return new_unpad, ratio, (dw, dh), (left, top, right, bottom)
+
+
+def letterbox_shape(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Output [height, width] of letterbox() for an image of shape [height, width]
+    (w, h), _, _, (left, top, right, bottom) = letterbox_params(shape, new_shape, auto, scaleFill, scaleup, stride)
+    return h + top + bottom, w + left + right
+
+
+def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Resize and pad image while meeting stride-multiple constraints
+    shape = img.shape[:2]  # current shape [height, width]
+    new_unpad, ratio, (dw, dh), (left, top, right, bottom) = letterbox_params(shape, new_shape, auto, scaleFill,
+                                                                             scaleup, stride)
+
+    if shape[::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
     img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return img, ratio, (dw, dh)
+
+
+def letterbox_into(img, out, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True,
+                   stride=32):
+    # letterbox() written in place into a preallocated HWC array, resizing straight into the padded region
+    shape = img.shape[:2]  # current shape [height, width]
+    new_unpad, ratio, (dw, dh), (left, top, right, bottom) = letterbox_params(shape, new_shape, auto, scaleFill,
+                                                                             scaleup, stride)
+    w, h = new_unpad
+    if out.shape[:2] != (h + top + bottom, w + left + right):
+        raise ValueError(f'letterbox output {out.shape[:2]} does not match {(h + top + bottom, w + left + right)}')
+
+    # Border only, the interior is fully overwritten below
+    out[:top] = color
+    out[top + h:] = color
+    out[top:top + h, :left] = color
+    out[top:top + h, left + w:] = color
+
+    roi = out[top:top + h, left:left + w]
+    if shape[::-1] != new_unpad:  # resize
+        resized = cv2.resize(img, new_unpad, dst=roi, interpolation=cv2.INTER_LINEAR)
+        if not np.shares_memory(resized, roi):  # OpenCV could not write into the view
+            roi[...] = resized
+    else:
+        roi[...] = img
+    return out, ratio, (dw, dh)
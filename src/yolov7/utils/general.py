@@ -9,12 +9,11 @@ from pathlib import Path
 
 import numpy as np
 import torch
-import torchvision
 
+from yolov7.utils.nms import get_engine, torchvision_nms
 
-# Settings
-torch.set_printoptions(linewidth=320, precision=5, profile='long')
-np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
+
+# Settings, torch/numpy print options are left to the application
 os.environ['NUMEXPR_MAX_THREADS'] = str(min(os.cpu_count(), 8))  # NumExpr max threads
 
 
@@ -67,6 +66,22 @@ def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     return coords
 
 
+def scale_coords_batch(img1_shape, coords, img0_shapes, image_ids):
+    # scale_coords() for the rows of several images at once, image_ids(n,) indexes img0_shapes
+    params = []  # gain, x pad, y pad, width, height
+    for img0_shape in img0_shapes:
+        gain = min(img1_shape[0] / img0_shape[0], img1_shape[1] / img0_shape[1])  # gain  = old / new
+        params.append((gain, (img1_shape[1] - img0_shape[1] * gain) / 2, (img1_shape[0] - img0_shape[0] * gain) / 2,
+                       img0_shape[1], img0_shape[0]))
+    p = torch.tensor(params, dtype=torch.float32, device=coords.device)[image_ids]  # a half gain would round
+    coords[:, [0, 2]] -= p[:, 1:2]  # x padding
+    coords[:, [1, 3]] -= p[:, 2:3]  # y padding
+    coords[:, :4] /= p[:, 0:1]
+    coords[:, [0, 2]] = coords[:, [0, 2]].clamp(min=0).minimum(p[:, 3:4])  # clip x
+    coords[:, [1, 3]] = coords[:, [1, 3]].clamp(min=0).minimum(p[:, 4:5])  # clip y
+    return coords
+
+
 def clip_coords(boxes, img_shape):
     # Clip bounding xyxy bounding boxes to image shape (height, width)
     boxes[:, 0].clamp_(0, img_shape[1])  # x1
@@ -101,27 +116,40 @@ def box_iou(box1, box2):
 
 
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), class_subset=False, max_det=300, max_nms=30000, time_limit=10.0,
+                        engine='torchvision'):
     """Runs Non-Maximum Suppression (NMS) on inference results
+    prediction: (bs,n,no) head output, or the sparse (rows(n,no), image index(n,), bs) candidates of a head with
+                candidate_thresh set
+    class_subset: prediction comes from a head sliced to some classes (Model.select_classes), so a single class
+                  column is still a real class score
+    max_det: maximum number of detections per image
+    max_nms: maximum number of boxes per image into the NMS engine, the most confident are kept
+    time_limit: seconds after which the remaining images are left empty with a warning, None for no limit
+    engine: NMS engine name or callable, see yolov7.utils.nms
 
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
 
-    nc = prediction.shape[2] - 5  # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
+    if isinstance(prediction, tuple):  # sparse candidates, split per image
+        rows, image_ids, bs = prediction
+        prediction = [rows[image_ids == i] for i in range(bs)]
+        xc = [x[:, 4] > conf_thres for x in prediction]
+        device, nc = rows.device, rows.shape[1] - 5
+    else:
+        xc = prediction[..., 4] > conf_thres  # candidates
+        device, nc = prediction.device, prediction.shape[2] - 5  # number of classes
 
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 10.0  # seconds to quit after
+    nms = get_engine(engine)
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
     t = time.time()
-    output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
+    output = [torch.zeros((0, 6), device=device)] * len(prediction)
     for xi, x in enumerate(prediction):  # image index, image inference
         # Apply constraints
         # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
@@ -141,7 +169,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
             continue
 
         # Compute conf
-        if nc == 1:
+        if nc == 1 and not class_subset:
             x[:, 5:] = x[:, 4:5] # for models with one class, cls_loss is 0 and cls_conf is always 0.5,
                                  # so there is no need to multiplicate.
         else:
@@ -176,7 +204,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+        i = nms(boxes, scores, iou_thres)  # NMS
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
         if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
@@ -188,13 +216,102 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
                 i = i[iou.sum(1) > 1]  # require redundancy
 
         output[xi] = x[i]
-        if (time.time() - t) > time_limit:
+        if time_limit is not None and (time.time() - t) > time_limit:
             print(f'WARNING: NMS time limit {time_limit}s exceeded')
             break  # time limit exceeded
 
     return output
 
 
+def batched_non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, class_subset=False, max_det=300, max_nms=30000,
+                                engine='torchvision', flat=False):
+    """non_max_suppression() for a whole batch without a Python loop over images: one confidence mask over the batch,
+    an image index carried per row, and a single NMS call with boxes offset by image and class. No time limit.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         or with flat=True all detections (n,6) in image order and detections per image (bs,)
+    """
+
+    # Settings
+    max_wh = 4096  # (pixels) maximum box width and height
+    nms = get_engine(engine)
+
+    if isinstance(prediction, tuple):  # sparse candidates
+        x, image_ids, bs = prediction
+        order = _image_order(image_ids)  # keeps the dense order within an image
+        x, image_ids = x[order], image_ids[order]
+        keep = x[:, 4] > conf_thres
+        x, image_ids = x[keep], image_ids[keep]
+    else:
+        bs = prediction.shape[0]
+        image_ids, anchors = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # candidates
+        x = prediction[image_ids, anchors]
+    nc = x.shape[1] - 5  # number of classes
+    multi_label &= nc > 1  # multiple labels per box
+    # rows for a single NMS call, the pure-tensor engines hold (n,n) IoU matrices
+    max_batched = 5000 if x.device.type != 'cpu' and nms is torchvision_nms else 1000
+
+    # Compute conf
+    if nc == 1 and not class_subset:
+        x[:, 5:] = x[:, 4:5]  # one class models, see non_max_suppression()
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    box = xywh2xyxy(x[:, :4])
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, image_ids = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), image_ids[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x, image_ids = torch.cat((box, conf, j.float()), 1)[keep], image_ids[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, image_ids = x[keep], image_ids[keep]
+
+    # Excess boxes, keep the max_nms most confident of an image
+    if len(x) > max_nms and torch.bincount(image_ids, minlength=bs).max() > max_nms:
+        order = x[:, 4].argsort(descending=True)
+        order = order[_image_order(image_ids[order])]  # by image, then confidence
+        keep = order[_rank(image_ids[order], bs) < max_nms]
+        x, image_ids = x[keep], image_ids[keep]
+
+    # Batched NMS, rows are in image order from here on
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    if len(x) <= max_batched:  # one call, offset by image in float64 for precision
+        span = max_wh * (1 if agnostic else nc + 1)  # offset between images
+        i = nms(boxes.double() + image_ids[:, None].double() * span, scores.double(), iou_thres)
+        i = i[_image_order(image_ids[i])]  # by image, then score
+    else:  # NMS is quadratic in the boxes, one call per image is cheaper than the Python loop by now
+        ends = torch.bincount(image_ids, minlength=bs).cumsum(0).tolist()
+        i = torch.cat([nms(boxes[lo:hi], scores[lo:hi], iou_thres) + lo for lo, hi in zip([0] + ends[:-1], ends)])
+    i = i[_rank(image_ids[i], bs) < max_det]  # limit detections per image
+    x, counts = x[i], torch.bincount(image_ids[i], minlength=bs)
+
+    if flat:
+        return x, counts
+    return list(x.split(counts.tolist()))
+
+
+def _image_order(image_ids):
+    # stable argsort of image_ids, Tensor.sort(stable=True) needs torch>=1.9
+    n = len(image_ids)
+    return (image_ids * n + torch.arange(n, device=image_ids.device)).argsort()
+
+
+def _rank(image_ids, bs):
+    # position of each row among the rows of its image, image_ids sorted
+    counts = torch.bincount(image_ids, minlength=bs)
+    starts = counts.cumsum(0) - counts
+    return torch.arange(len(image_ids), device=image_ids.device) - starts[image_ids]
+
+
 def increment_path(path, exist_ok=True, sep=''):
     # Increment path, i.e. runs/exp --> runs/exp{sep}0, runs/exp{sep}1 etc.
     path = Path(path)  # os-agnostic
@@ -0,0 +1,73 @@
+# NMS engines
+# Every engine takes xyxy boxes(n,4) and scores(n,) and returns the indices of the kept boxes by decreasing score,
+# like torchvision.ops.nms(). Boxes of different classes/images are kept apart by offsetting them, see
+# batched_non_max_suppression().
+
+import numpy as np
+import torch
+
+
+def _iou_matrix(boxes):
+    # pairwise IoU of boxes(n,4) sorted by decreasing score, upper triangle only (IoU with higher scored boxes)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    lt = torch.max(boxes[:, None, :2], boxes[None, :, :2])
+    rb = torch.min(boxes[:, None, 2:], boxes[None, :, 2:])
+    inter = (rb - lt).clamp(min=0).prod(2)
+    return (inter / (area[:, None] + area[None, :] - inter)).triu_(diagonal=1)
+
+
+def torchvision_nms(boxes, scores, iou_thres):
+    import torchvision  # ~1 s to import, paid by the first NMS rather than by importing yolov7
+
+    return torchvision.ops.nms(boxes, scores, iou_thres)
+
+
+def fast_nms(boxes, scores, iou_thres):
+    # Fast NMS (YOLACT, https://arxiv.org/abs/1904.02689): a box is dropped if it overlaps any higher scored box,
+    # suppressed or not. Fully parallel, may drop slightly more boxes than sequential NMS.
+    order = scores.argsort(descending=True)
+    iou = _iou_matrix(boxes[order])
+    return order[iou.max(0)[0] <= iou_thres] if len(order) else order
+
+
+def matrix_nms(boxes, scores, iou_thres):
+    # Matrix NMS (SOLOv2, https://arxiv.org/abs/2003.10152) with linear decay, as hard suppression: the overlap with
+    # a higher scored box is discounted by how much that box overlaps higher scored ones itself, if it is above
+    # iou_thres. A box is kept while its decay factor stays at or above 1 - iou_thres, so unsuppressed boxes suppress
+    # like sequential NMS and suppressed ones only their near duplicates. Fully parallel.
+    order = scores.argsort(descending=True)
+    if not len(order):
+        return order
+    iou = _iou_matrix(boxes[order])
+    compensate = iou.max(0)[0]  # how much each box is suppressed by higher scored ones
+    compensate = torch.where(compensate > iou_thres, compensate, torch.zeros_like(compensate))
+    decay = ((1 - iou) / (1 - compensate[:, None]).clamp(min=1e-6)).min(0)[0]
+    return order[decay >= 1 - iou_thres]
+
+
+def numpy_nms(boxes, scores, iou_thres):
+    # greedy NMS on the host, for builds without the torchvision NMS kernel
+    b, s = boxes.detach().cpu().double().numpy(), scores.detach().cpu().double().numpy()
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    order = s.argsort(kind='stable')[::-1]
+    keep = []
+    while order.size:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        lt = np.maximum(b[i, :2], b[rest, :2])
+        rb = np.minimum(b[i, 2:], b[rest, 2:])
+        inter = np.clip(rb - lt, 0, None).prod(1)
+        order = rest[inter / (area[i] + area[rest] - inter) <= iou_thres]
+    return torch.as_tensor(np.array(keep, dtype=np.int64), device=boxes.device)
+
+
+engines = {'torchvision': torchvision_nms, 'fast': fast_nms, 'matrix': matrix_nms, 'numpy': numpy_nms}
+
+
+def get_engine(engine):
+    # engine name or callable(boxes, scores, iou_thres) -> keep
+    if callable(engine):
+        return engine
+    if engine not in engines:
+        raise ValueError(f'NMS engine "{engine}" not supported, use one of {list(engines)}')
+    return engines[engine]
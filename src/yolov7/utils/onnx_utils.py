@@ -0,0 +1,86 @@
+# ONNX export and ONNX Runtime inference
+
+import inspect
+import json
+from copy import deepcopy
+
+import torch
+
+from yolov7.models.yolo import Detect, IDetect
+
+
+def export_onnx(model, class_names, f, img_size=640, dynamic=True, opset=12):
+    # Writes the fused model with its decoded predictions (bs, anchors, 5 + nc) as output, NMS is left to the caller.
+    # The batch axis is always dynamic, dynamic=True makes the input height and width dynamic as well. Class names
+    # and strides are stored in the metadata for OnnxModel.
+    import onnx
+
+    if getattr(model, 'input_folded', False) or getattr(model, 'class_ids', None) is not None:
+        raise ValueError('export the model before fold_input() or select_classes()')
+    model = deepcopy(model).float().cpu().eval()
+    model.traced = False
+    m = model.model[-1]  # Detect() module
+    if not isinstance(m, (Detect, IDetect)):
+        raise ValueError(f'cannot export a {type(m).__name__} head')
+    m.concat = True  # decoded predictions only
+
+    axes = {'images': {0: 'batch', 2: 'height', 3: 'width'} if dynamic else {0: 'batch'},
+            'output': {0: 'batch', 1: 'anchors'}}
+    legacy = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model, torch.zeros((1, 3, img_size, img_size)), f, opset_version=opset,
+                          input_names=['images'], output_names=['output'], dynamic_axes=axes,
+                          do_constant_folding=True, **legacy)
+
+    onnx_model = onnx.load(f)
+    onnx.checker.check_model(onnx_model)
+    metadata = {'class_names': json.dumps(list(class_names)), 'stride': json.dumps(m.stride.tolist()),
+                'img_size': str(img_size), 'dynamic': str(bool(dynamic))}
+    for key, value in metadata.items():
+        entry = onnx_model.metadata_props.add()
+        entry.key, entry.value = key, value
+    onnx.save(onnx_model, f)
+    return onnx_model
+
+
+class OnnxModel:
+    # ONNX Runtime session over a graph written by export_onnx(). Called like Model up to and including Detect:
+    # letterboxed (bs, 3, h, w) input in, ((bs, anchors, 5 + nc) predictions, None) out.
+    def __init__(self, f, device=torch.device('cpu'), providers=None, threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError('backend="onnxruntime" needs onnxruntime, pip install onnxruntime') from e
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(f), options, providers=providers or ['CPUExecutionProvider'])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if 'class_names' not in metadata:
+            raise ValueError(f'{f} has no yolov7 metadata, export it with export_onnx()')
+        self.class_names = json.loads(metadata['class_names'])
+        self.stride = torch.tensor(json.loads(metadata['stride']))
+        self.img_size = int(metadata['img_size'])
+        self.dynamic = metadata['dynamic'] == 'True'  # any input height and width, else img_size only
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = device  # of the returned predictions, see to()
+        self.class_ids = None  # original class of each output class, see select_classes()
+        self._columns = None
+
+    def to(self, device):
+        self.device = torch.device(device)
+        return self
+
+    def select_classes(self, class_ids):
+        # keep box, obj and the given classes of the output, like Model.select_classes() does in the head
+        self.class_ids = [int(c) for c in class_ids]
+        self._columns = torch.tensor(list(range(5)) + [5 + c for c in self.class_ids])
+        return self
+
+    def __call__(self, x):
+        pred = torch.from_numpy(self.session.run(None, {self.input_name: x.detach().cpu().numpy()})[0])
+        if self._columns is not None:
+            pred = pred[..., self._columns]
+        return pred.to(self.device), None
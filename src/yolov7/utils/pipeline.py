@@ -0,0 +1,85 @@
+# Threaded stage pipelines
+
+import queue
+import threading
+
+_DONE = object()  # end of stream marker
+
+
+class _Failure:
+    # exception raised inside a stage, forwarded downstream and re-raised in the consumer
+    __slots__ = ('exc',)
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def _feed(source, fn, out, stop):
+    # first stage, iterates the source itself so lazy sources (e.g. video readers) are read off the consumer thread
+    try:
+        for item in source:
+            if not _put(out, fn(item), stop):
+                return
+    except BaseException as e:
+        _put(out, _Failure(e), stop)
+        return
+    _put(out, _DONE, stop)
+
+
+def _relay(inp, fn, out, stop):
+    while True:
+        item = _get(inp, stop)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(out, item, stop)
+            return
+        try:
+            item = fn(item)
+        except BaseException as e:
+            _put(out, _Failure(e), stop)
+            return
+        if not _put(out, item, stop):
+            return
+
+
+def pipelined(source, *stages, depth=2):
+    # Yields stages[-1](...stages[0](item)) for every item of source, in order. Each stage runs in its own thread,
+    # so stage k works on item i while stage k+1 works on item i-1. Queues between stages hold at most depth items.
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=depth) for _ in stages]
+    threads = [threading.Thread(target=_feed, args=(source, stages[0], queues[0], stop), daemon=True)]
+    threads += [threading.Thread(target=_relay, args=(queues[i - 1], stages[i], queues[i], stop), daemon=True)
+                for i in range(1, len(stages))]
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()  # also reached when the consumer stops iterating early
+        for t in threads:
+            t.join()
@@ -0,0 +1,132 @@
+# Batched letterbox preprocessing into reusable input buffers
+
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+from yolov7.utils.datasets import letterbox_into, letterbox_shape
+
+
+class InputSlot:
+    # One reusable (bs, h, w) input: host uint8 NHWC staging array and the normalised NCHW model input
+    __slots__ = ('key', 'staging', 'upload', 'input')
+
+    def __init__(self, key, staging, upload, input):
+        self.key = key  # (bs, h, w)
+        self.staging = staging  # ndarray(bs,h,w,3) uint8, letterboxed frames are resized straight into it
+        self.upload = upload  # staging as a tensor on the model device
+        self.input = input  # tensor(bs,3,h,w) float model input
+
+    @property
+    def shape(self):
+        return tuple(self.input.shape[1:])  # (3, h, w)
+
+
+class Preprocessor:
+    # Letterboxes frames into pooled NCHW input buffers, one pool per (batch size, input shape).
+    # Frames are resized directly into their padded slot and the whole batch is normalised in one pass.
+    # With workers > 0 frames are letterboxed concurrently, OpenCV releases the GIL while resizing.
+    color = (114, 114, 114)  # letterbox padding
+
+    def __init__(self, img_size=640, stride=32, auto=True, device=torch.device('cpu'), half=False, bgr=True,
+                 scale=True, workers=0):
+        self.img_size = img_size
+        self.stride = stride
+        self.auto = auto  # minimum rectangle padding, see letterbox()
+        self.device = device
+        self.dtype = torch.float16 if half else torch.float32
+        self.bgr = bgr  # swap BGR to RGB
+        self.scale = scale  # scale 0-255 to 0-1, False for models with the scaling folded in
+        self._free = {}  # (bs, h, w): [InputSlot]
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='letterbox') if workers > 0 else None
+
+    def resized(self, img_size):
+        # same settings and letterbox workers for another input size, with its own buffer pools. close() the original.
+        other = copy.copy(self)
+        other.img_size = img_size
+        other._free = {}
+        other._lock = threading.Lock()
+        return other
+
+    def input_shape(self, img):
+        return letterbox_shape(img.shape[:2], self.img_size, auto=self.auto, stride=self.stride)
+
+    def acquire(self, bs, h, w):
+        key = (bs, h, w)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+        return self._new_slot(key)
+
+    def release(self, slot):
+        with self._lock:
+            self._free.setdefault(slot.key, []).append(slot)
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self.clear()
+
+    def _new_slot(self, key):
+        bs, h, w = key
+        staging = torch.empty((bs, h, w, 3), dtype=torch.uint8, pin_memory=self.device.type == 'cuda')
+        if self.device.type != 'cpu':
+            upload = torch.empty((bs, h, w, 3), dtype=torch.uint8, device=self.device)
+        else:
+            upload = staging
+        input = torch.empty((bs, 3, h, w), dtype=self.dtype, device=self.device)
+        return InputSlot(key, staging.numpy(), upload, input)
+
+    def load(self, imgs):
+        # Letterbox a list of HWC frames into an acquired input slot and normalise it, release() the slot after use
+        shapes = {self.input_shape(img) for img in imgs}
+        if len(shapes) > 1:
+            raise ValueError(f'frames letterbox to different input shapes {sorted(shapes)}, pad with auto=False')
+        slot = self.acquire(len(imgs), *shapes.pop())
+        try:
+            if self._pool is not None and len(imgs) > 1:
+                for _ in self._pool.map(self.letterbox, imgs, slot.staging):
+                    pass  # re-raises worker errors
+            else:
+                for img, out in zip(imgs, slot.staging):
+                    self.letterbox(img, out)
+            self.normalise(slot)
+        except BaseException:
+            self.release(slot)
+            raise
+        return slot
+
+    def letterbox(self, img, out):
+        return letterbox_into(img, out, self.img_size, color=self.color, auto=self.auto, stride=self.stride)
+
+    def normalise(self, slot):
+        # uint8 NHWC (BGR or RGB) to float NCHW RGB in [0, 1], one pass per channel over the batch
+        if self.device.type != 'cpu':
+            slot.upload.copy_(torch.from_numpy(slot.staging))  # uint8 host to device, a quarter of the float traffic
+        if not self.bgr and not self.scale:
+            return slot.input.copy_(slot.upload.permute(0, 3, 1, 2))  # single cast pass
+        for c in range(3):
+            src = slot.upload[..., 2 - c if self.bgr else c]
+            if self.scale:
+                torch.div(src, 255, out=slot.input[:, c])
+            else:
+                slot.input[:, c].copy_(src)
+        return slot.input
+
+    @contextmanager
+    def batch(self, imgs):
+        slot = self.load(imgs)
+        try:
+            yield slot.input
+        finally:
+            self.release(slot)
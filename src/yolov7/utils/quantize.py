@@ -0,0 +1,100 @@
+# Post-training static INT8 quantisation for CPU inference
+
+from copy import deepcopy
+from itertools import islice
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from yolov7.models.yolo import QuantizedModel
+from yolov7.utils.preprocess import Preprocessor
+
+
+class _Backbone(nn.Module):
+    # the layers of a Model up to Detect(), what FX traces and quantizes
+    def __init__(self, model):
+        super(_Backbone, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_once(x)
+
+
+def quantize_model(model, images, img_size=640, bgr=True, batch_size=8, qengine='x86'):
+    # Quantize a fused Model with FX graph mode post-training static quantization: observers are inserted into the
+    # layers up to Detect(), calibrated on images (iterable of HWC uint8 frames, BGR if bgr) letterboxed like at
+    # inference, then the conv stacks are converted to INT8. Detect() keeps its float convs and decode.
+    # qengine: 'x86' (or 'fbgemm') for x86 CPUs, 'qnnpack' for ARM.
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    if qengine not in torch.backends.quantized.supported_engines:
+        raise ValueError(f'quantized engine "{qengine}" not supported here, use one of '
+                         f'{torch.backends.quantized.supported_engines}')
+    torch.backends.quantized.engine = qengine
+
+    model = deepcopy(model).float().cpu().eval()
+    model.traced = True  # Model.forward_once stops before Detect
+    for m in model.modules():
+        if hasattr(m, 'inplace'):
+            m.inplace = False  # quantized activations are not in-place
+    stride = int(model.stride.max())
+    preprocessor = Preprocessor(img_size, stride=stride, auto=False, bgr=bgr and not model.input_folded,
+                                scale=not model.input_folded)
+
+    example = torch.zeros((1, 3, img_size, img_size))
+    prepared = prepare_fx(_Backbone(model), get_default_qconfig_mapping(qengine), example_inputs=(example,))
+    images, n = iter(images), 0
+    with torch.no_grad():
+        while True:
+            batch = list(islice(images, batch_size))
+            if not batch:
+                break
+            with preprocessor.batch(batch) as x:
+                prepared(x)  # observers record activation ranges
+            n += len(batch)
+    if not n:
+        raise ValueError('no calibration images')
+    backbone = torch.jit.script(convert_fx(prepared))  # FX graphs of quantized modules do not survive pickling
+
+    model.traced = False
+    return QuantizedModel(model, backbone, qengine=qengine)
+
+
+def _iou(a, b):
+    # IoU matrix of ltrb boxes a(n,4) and b(m,4)
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(2)
+    area = lambda x: (x[:, 2] - x[:, 0]) * (x[:, 3] - x[:, 1])
+    return inter / np.maximum(area(a)[:, None] + area(b)[None, :] - inter, 1e-9)
+
+
+def detection_delta(reference, detections, iou_thres=0.5):
+    # Compare per image (boxes ltrb, scores, class_ids) detections, e.g. DetectionBatch, against a reference such as
+    # the fp32 model. Detections are greedily matched by score to a reference detection of the same class.
+    # Returns recall (reference detections found), precision (detections that match one), mean IoU and mean absolute
+    # score difference of the matches.
+    totals = {'reference': 0, 'detections': 0, 'matched': 0}
+    ious, score_deltas = [], []
+    for (rb, rs, rc), (db, ds, dc) in zip(reference, detections):
+        totals['reference'] += len(rs)
+        totals['detections'] += len(ds)
+        if not len(rs) or not len(ds):
+            continue
+        iou = _iou(np.asarray(db, dtype=np.float64), np.asarray(rb, dtype=np.float64))
+        iou[np.asarray(dc)[:, None] != np.asarray(rc)[None, :]] = 0  # same class only
+        taken = np.zeros(len(rs), dtype=bool)
+        for i in np.argsort(-np.asarray(ds), kind='stable'):
+            j = np.where(taken, -1, iou[i]).argmax()
+            if iou[i, j] >= iou_thres and not taken[j]:
+                taken[j] = True
+                ious.append(iou[i, j])
+                score_deltas.append(abs(float(ds[i]) - float(rs[j])))
+        totals['matched'] += int(taken.sum())
+    return {**totals,
+            'recall': totals['matched'] / max(totals['reference'], 1),
+            'precision': totals['matched'] / max(totals['detections'], 1),
+            'mean_iou': float(np.mean(ious)) if ious else 0.,
+            'mean_score_delta': float(np.mean(score_deltas)) if score_deltas else 0.}
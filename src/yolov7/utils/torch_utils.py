@@ -1,17 +1,20 @@
 # YOLOR PyTorch utils
 
+import hashlib
+import json
 import logging
 import math
+import os
+import tempfile
 import time
+from functools import reduce
+from itertools import chain
+from pathlib import Path
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-try:
-    import thop  # for FLOPS computation
-except ImportError:
-    thop = None
 logger = logging.getLogger(__name__)
 
 
@@ -140,9 +143,93 @@ def revert_sync_batchnorm(module):
     return module_output
 
 
+def _tensors(x):
+    # tensors nested in a state_dict value or packed params state, in order
+    if isinstance(x, torch.Tensor):
+        yield x
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            yield from _tensors(v)
+
+
+def state_digest(model):
+    # sha256 of the names, dtypes, shapes and values of the state_dict, INT8 weights with their quantization params
+    state = list(model.state_dict().items())
+    state += [(f'{name}._packed_params', m._packed_params.__getstate__()) for name, m in model.named_modules()
+              if isinstance(getattr(m, '_packed_params', None), torch.ScriptObject)]  # not in scripted state_dicts
+    h = hashlib.sha256()
+    for name, value in state:
+        tensors = list(_tensors(value))
+        if not tensors:
+            h.update(f'{name}:{value!r};'.encode())
+        for t in tensors:
+            t = t.detach()
+            h.update(f'{name}:{t.dtype}:{tuple(t.shape)};'.encode())
+            if t.is_quantized:
+                per_channel = t.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric)
+                params = ((t.q_per_channel_scales(), t.q_per_channel_zero_points()) if per_channel else
+                          (torch.tensor(t.q_scale()), torch.tensor(t.q_zero_point())))
+                t = torch.cat([u.contiguous().view(-1).view(torch.uint8) for u in (t.int_repr(),) + params])
+            h.update(t.contiguous().view(-1).view(torch.uint8).cpu().numpy())
+    return h.hexdigest()
+
+
+def trace_key(model, img_size, example):
+    # content address of a traced graph: weights, cfg, input size, dtype, device type and torch version
+    key = {'weights': state_digest(model), 'cfg': getattr(model, 'yaml', None), 'img_size': img_size,
+           'dtype': str(example.dtype), 'device': example.device.type, 'torch': torch.__version__}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def share_weights(traced, model):
+    # point the parameters and buffers of a loaded ScriptModule at the eager model's tensors, so that both share
+    # one copy of the weights like a freshly traced module does. False if the two do not match.
+    own = dict(chain(model.named_parameters(), model.named_buffers()))
+    tensors = list(chain(traced.named_parameters(), traced.named_buffers()))
+    if any(name not in own or own[name].shape != t.shape or own[name].dtype != t.dtype for name, t in tensors):
+        return False
+    for name, _ in tensors:
+        path, _, leaf = name.rpartition('.')
+        setattr(reduce(getattr, path.split('.'), traced) if path else traced, leaf, own[name])
+    return True
+
+
+def load_trace(f, model, device):
+    # cached trace sharing model's weights, None if missing or unusable
+    try:
+        traced = torch.jit.load(f, map_location=device)
+    except (OSError, RuntimeError) as e:
+        logger.warning(f'ignoring unreadable trace cache {f}: {e}')
+        return None
+    return traced if share_weights(traced, model) else None
+
+
+def save_trace(traced, f):
+    # write to a temporary file next to f and rename it into place, concurrent readers never see a partial file
+    f = Path(f)
+    try:
+        f.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=f.parent, prefix=f'.{f.stem}.', suffix='.tmp')
+    except OSError as e:
+        logger.warning(f'not caching trace in {f.parent}: {e}')
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            torch.jit.save(traced, file)
+        os.chmod(tmp, 0o644)  # mkstemp creates 0600, other workers may run as other users
+        os.replace(tmp, f)
+        return True
+    except (OSError, RuntimeError) as e:
+        logger.warning(f'not caching trace in {f.parent}: {e}')
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+
+
 class TracedModel(nn.Module):
 
-    def __init__(self, model=None, device=None, img_size=(640,640)):
+    def __init__(self, model=None, device=None, img_size=(640,640), cache_dir=None):
+        # cache_dir: directory of traced graphs shared across processes, keyed by trace_key(). None always traces.
         super(TracedModel, self).__init__()
         
         print(" Convert model to Traced-model... ")
@@ -151,18 +238,24 @@ class TracedModel(nn.Module):
         self.model = model
 
         self.model = revert_sync_batchnorm(self.model)
-        self.model.to('cpu')
+        self.model.to(device)
         self.model.eval()
 
         self.detect_layer = self.model.model[-1]
         self.model.traced = True
         
-        rand_example = torch.rand(1, 3, img_size, img_size)
-        
-        traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
-        #traced_script_module = torch.jit.script(self.model)
-        traced_script_module.save("traced_model.pt")
-        print(" traced_script_module saved! ")
+        p = next(self.model.parameters())  # trace on the model's device and dtype, the weights stay shared
+        rand_example = torch.rand(1, 3, img_size, img_size, device=p.device).to(p.dtype)
+
+        f = Path(cache_dir).expanduser() / f'{trace_key(self.model, img_size, rand_example)}.pt' if cache_dir else None
+        traced_script_module = load_trace(f, self.model, p.device) if f is not None and f.is_file() else None
+        if traced_script_module is not None:
+            print(f" traced_script_module loaded from {f} ")
+        else:
+            traced_script_module = torch.jit.trace(self.model, rand_example, strict=False)
+            #traced_script_module = torch.jit.script(self.model)
+            if f is not None and save_trace(traced_script_module, f):
+                print(f" traced_script_module saved to {f} ")
         self.model = traced_script_module
         self.model.to(device)
         self.detect_layer.to(device)
@@ -172,3 +265,27 @@ class TracedModel(nn.Module):
         out = self.model(x)
         out = self.detect_layer(out)
         return out
+
+
+class CompiledModel:
+    # torch.compile() (inductor) of a Model up to Detect(), which stays eager like with TracedModel. The batch dimension
+    # is dynamic from the start (batch 1 gets a graph of its own) and input sizes that change later are made dynamic by
+    # torch, so varying batch sizes and letterbox shapes reuse a couple of graphs instead of compiling one per shape.
+    # Compiling happens on the first call, if it fails the model runs eager from then on.
+    def __init__(self, model, mode=None):
+        if not hasattr(torch, 'compile'):
+            raise ValueError(f'torch.compile() needs torch>=2.0, found {torch.__version__}')
+        model.traced = True  # Model.forward stops before Detect
+        self.model = model
+        self.compiled = torch.compile(model, backend='inductor', mode=mode)
+
+    def __call__(self, x):
+        compiled = self.compiled
+        if compiled is not None:
+            torch._dynamo.maybe_mark_dynamic(x, 0)
+            try:
+                return compiled(x)
+            except Exception as e:  # inductor raises many types, e.g. without a working C++ compiler
+                logger.warning(f'torch.compile() failed, running eager: {e}')
+                self.compiled = None
+        return self.model(x)
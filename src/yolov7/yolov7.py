@@ -1,13 +1,28 @@
-import cv2
+import asyncio
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import islice
+from pathlib import Path
+
 import numpy as np
 import torch
 from importlib_resources import files
 
-from yolov7.models.experimental import attempt_load_state_dict
-from yolov7.models.yolo import Model
-from yolov7.utils.datasets import letterbox
-from yolov7.utils.general import scale_coords, non_max_suppression, check_img_size
-from yolov7.utils.torch_utils import TracedModel
+from yolov7.detections import DetectionBatch
+from yolov7.models.experimental import Ensemble, attempt_load_state_dict
+from yolov7.models.yolo import QuantizedModel
+from yolov7.utils.batching import MicroBatcher
+from yolov7.utils.general import scale_coords_batch, batched_non_max_suppression, check_img_size
+from yolov7.utils.nms import get_engine
+from yolov7.utils.onnx_utils import OnnxModel
+from yolov7.utils.pipeline import pipelined
+from yolov7.utils.preprocess import Preprocessor
+from yolov7.utils.torch_utils import CompiledModel, TracedModel
 
 
 @torch.no_grad()
@@ -17,14 +32,36 @@ class YOLOv7:
         'device': 'cuda',
         'conf_thresh': 0.25,
         'nms_thresh': 0.45,
+        'nms_engine': 'torchvision',  # 'torchvision', 'fast', 'matrix', 'numpy' or a callable, see utils/nms.py
+        'max_det': 300,  # detections kept per image
+        'max_nms': 30000,  # most confident boxes per image going into NMS
         'model_image_size': 640,
         'max_batch_size': 4,
         'half': True,
         'same_size': True,
-        'weights': files('yolov7').joinpath('weights/yolov7_state.pt'),
-        'cfg': files('yolov7').joinpath('cfg/deploy/yolov7.yaml'),
+        'weights': files('yolov7').joinpath('weights/yolov7_state.pt'),  # a list for an ensemble, see export_deploy()
+        'cfg': files('yolov7').joinpath('cfg/deploy/yolov7.yaml'),  # or one per ensemble member
         'trace': True,
+        'backend': None,  # None (trace or eager), 'compile' (torch.compile) or 'onnxruntime' (export_onnx() weights)
+        'onnx_providers': None,  # backend='onnxruntime': execution providers, CPUExecutionProvider by default
+        'compile_cache': None,  # backend='compile': directory keeping compiled kernels across runs (process wide)
+        'trace_cache': None,  # directory sharing traced models across processes, e.g. '~/.cache/yolov7'
+        'mmap_weights': False,  # memory-map the checkpoint, CPU workers loading the same file share its pages
+        'trusted_weights': False,  # allow deploy and other checkpoints that need full unpickling, which can run code
         'cudnn_benchmark': False,
+        'pipeline': False,  # overlap preprocessing, forward and postprocessing of consecutive batches in threads
+        'pipeline_depth': 2,  # batches queued between pipeline stages
+        'fold_input': False,  # fold BGR->RGB swap and 1/255 scaling into the first conv, the model takes raw frames
+        'preprocess_workers': 0,  # threads letterboxing the frames of a batch concurrently, 0 to letterbox inline
+        'bucket_shapes': False,  # letterbox to minimum rectangles and batch frames of equal input shape together
+        'bucket_window': 64,  # frames read ahead and grouped into shape buckets
+        'batch_wait_ms': 5.0,  # submit(): how long a partial batch waits for more requests before it runs
+        'async_workers': 1,  # threads running detect_async() calls off the event loop
+        'async_max_in_flight': 4,  # detect_async() calls admitted at once, later callers wait on the event loop
+        'classes': None,  # class names to build the detection head for, others are never computed or returned. Boxes
+                          # take their best class among these only, see detect_get_box_in
+        'resolution_cache': 4,  # inference sizes (img_size=) kept prepared, the least recently used is dropped
+        'early_filter': False,  # head decodes only anchors whose objectness can pass conf_thresh (fixed at init)
     }
 
     def __init__(self, **kwargs):
@@ -32,18 +69,53 @@ class YOLOv7:
         self.__dict__.update(kwargs)  # update with user overrides
 
         self.device, self.device_num = self._select_device(self.device)
-
-        model = Model(self.cfg)
-        self.model, self.class_names = attempt_load_state_dict(model, self.weights, map_location=torch.device('cpu'))
-        self.model.to(self.device)
-
-        self.model_stride = int(self.model.stride.max())  # model stride
+        get_engine(self.nms_engine)  # unknown engines fail here rather than on the first batch
+        if self.backend not in (None, 'compile', 'onnxruntime'):
+            raise ValueError(f'backend "{self.backend}" not supported, use None, "compile" or "onnxruntime"')
+
+        weights = self.weights if isinstance(self.weights, (list, tuple)) else [self.weights]
+        cfgs = self.cfg if isinstance(self.cfg, (list, tuple)) else [self.cfg] * len(weights)
+        if len(cfgs) != len(weights):
+            raise ValueError(f'{len(cfgs)} cfgs given for {len(weights)} weights')
+        if self.backend == 'onnxruntime':  # the exported graph includes Detect, its input is fixed at export
+            if len(weights) != 1 or self.fold_input or self.early_filter:
+                raise ValueError('backend "onnxruntime" runs a single model without fold_input or early_filter')
+            self.model = OnnxModel(weights[0], providers=self.onnx_providers)
+            class_names = self.model.class_names
+        else:
+            self.model, class_names = attempt_load_state_dict(list(cfgs), list(weights),
+                                                              map_location=torch.device('cpu'),
+                                                              fold_input=self.fold_input, bgr=self.bgr,
+                                                              mmap=self.mmap_weights, trusted=self.trusted_weights)
+        # ensemble members, each fused and traced on its own, run concurrently and share one NMS
+        self.members = list(self.model) if isinstance(self.model, Ensemble) else [self.model]
+        if isinstance(self.model, Ensemble):
+            if any(names != class_names[0] for names in class_names):
+                raise ValueError('ensemble members must be trained on the same class names')
+            class_names = class_names[0]
+        self.class_names = class_names
+
+        for member in self.members:
+            if isinstance(member, QuantizedModel):  # INT8, see utils/quantize.py
+                if self.device.type != 'cpu':
+                    raise ValueError('quantized models run on CPU only')
+                torch.backends.quantized.engine = member.qengine
+            if self.classes is not None:
+                member.select_classes([self.classname_to_idx(name) for name in self.classes])
+            member.to(self.device)
+            if self.early_filter:  # sparse candidates instead of the dense (bs, anchors, no) head output
+                member.model[-1].candidate_thresh = self.conf_thresh
+            if self.backend != 'onnxruntime':  # Detect grids of a square and a rectangle per cached resolution
+                member.model[-1].decode_cache_size = 2 * max(self.resolution_cache, 1)
+        # head output class j -> class_names index, None for the full head
+        self.head_class_ids = self.members[0].class_ids
+        self._head_class_map = (torch.tensor(self.head_class_ids, device=self.device)
+                                if self.head_class_ids is not None else None)
+
+        self.model_stride = max(int(member.stride.max()) for member in self.members)  # model stride
         self.model_image_size = check_img_size(self.model_image_size, s=self.model_stride)  # check img_size
 
-        if self.trace:
-            self.model = TracedModel(self.model, self.device, self.model_image_size)
-
-        if self.device == torch.device('cpu'):
+        if self.device == torch.device('cpu') or self.backend == 'onnxruntime':
             self.half = False
         if self.half:
             self.model.half()
@@ -53,8 +125,37 @@ class YOLOv7:
             torch.backends.cudnn.benchmark = True
             torch.backends.cudnn.enabled = True
 
+        # letterboxes straight into reusable input buffers, one pool per (batch size, input shape)
+        self.preprocessor = Preprocessor(self.model_image_size, stride=self.model_stride,
+                                         auto=(self.same_size or self.bucket_shapes) and self._dynamic_shapes,
+                                         device=self.device, half=self.half, bgr=self.bgr and not self.fold_input,
+                                         scale=not self.fold_input, workers=self.preprocess_workers)
+
+        # ensemble members besides the first run in these threads, each member on a CUDA stream of its own
+        ensemble = len(self.members) > 1
+        self._ensemble_pool = (ThreadPoolExecutor(len(self.members) - 1, thread_name_prefix='yolov7-ensemble')
+                               if ensemble else None)
+        self._ensemble_streams = ([torch.cuda.Stream(self.device) for _ in self.members]
+                                  if ensemble and self.device.type == 'cuda' else None)
+
+        # compiled once per member and shared by all inference sizes, torch guards and specialises per shape
+        if self.backend == 'compile':
+            if self.compile_cache is not None:
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = str(Path(self.compile_cache).expanduser())
+            self._compiled = [CompiledModel(member) for member in self.members]
+
+        # prepared state per inference size, the model weights are shared by all of them
+        self._resolutions = OrderedDict()  # img_size: _Resolution, least recently used first
+        self._resolutions_lock = threading.Lock()
+        self._resolution(self.model_image_size)
+
+        self._batcher = None  # started by the first submit()
+        self._batcher_lock = threading.Lock()
+        self._async_executor = None  # started by the first detect_async()
+        self._async_limits = weakref.WeakKeyDictionary()  # event loop: in-flight semaphore
+
         # warm up
-        self._detect([np.zeros((10, 10, 3), dtype=np.uint8)])
+        self.detect_get_box_in([np.zeros((10, 10, 3), dtype=np.uint8)])
         print('Warmed up!')
 
     @staticmethod
@@ -69,43 +170,191 @@ class YOLOv7:
     def classname_to_idx(self, classname):
         return self.class_names.index(classname)
 
-    def _detect(self, list_of_imgs):
-        if self.bgr:
-            list_of_imgs = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in list_of_imgs]
-
-        resized = [letterbox(img, new_shape=self.model_image_size, auto=self.same_size, stride=self.model_stride)[0] for img in list_of_imgs]
-        images = np.stack(resized, axis=0)
-        images = np.divide(images, 255, dtype=np.float32)
-        images = np.ascontiguousarray(images.transpose(0, 3, 1, 2))
-        input_shapes = [img.shape for img in images]
-
-        batches = []
-        for i in range(0, len(images), self.max_batch_size):
-            these_imgs = torch.from_numpy(images[i:i+self.max_batch_size])
-            if self.half:
-                these_imgs = these_imgs.half()
-            batches.append(these_imgs)
-
-        if self.device_num is not None:
-            with torch.cuda.device(self.device_num):
-                preds = self._batch_pred(batches)
-        else:
-            preds = self._batch_pred(batches)
+    def _head_class_idx(self, classname):
+        # index of a class among the head outputs
+        idx = self.classname_to_idx(classname)
+        if self.head_class_ids is None:
+            return idx
+        if idx not in self.head_class_ids:
+            raise ValueError(f'class {classname!r} is not among the classes the model was built for {self.classes}')
+        return self.head_class_ids.index(idx)
+
+    def _device_context(self):
+        return torch.cuda.device(self.device_num) if self.device_num is not None else nullcontext()
+
+    def _resolution(self, img_size=None):
+        # prepared state for an inference size: letterbox buffers, traced backbone, Detect grids. Built on first use
+        # and warmed up, at most resolution_cache of them are kept.
+        img_size = check_img_size(img_size or self.model_image_size, s=self.model_stride)
+        if not self._dynamic_shapes and img_size != self.model.img_size:
+            raise ValueError(f'the ONNX model was exported for img_size {self.model.img_size} only, got {img_size}')
+        with self._resolutions_lock:
+            resolution = self._resolutions.get(img_size)
+            if resolution is not None:
+                self._resolutions.move_to_end(img_size)
+                return resolution
+
+            with self._device_context(), torch.no_grad():
+                resolution = _Resolution(img_size, pool=self._ensemble_pool, streams=self._ensemble_streams)
+                if img_size == self.model_image_size:
+                    resolution.preprocessor = self.preprocessor
+                else:
+                    resolution.preprocessor = self.preprocessor.resized(img_size)
+                for i, member in enumerate(self.members):
+                    if self.backend == 'compile':
+                        backbone = self._compiled[i]
+                    elif self.backend == 'onnxruntime':
+                        resolution.members.append((member, None))  # the session runs Detect as well
+                        continue
+                    elif self.trace:
+                        backbone = TracedModel(member, self.device, img_size, cache_dir=self.trace_cache).model
+                    else:
+                        member.traced = True  # Model.forward stops before Detect
+                        backbone = member
+                    resolution.members.append((backbone, member.model[-1]))  # Detect grids are cached per shape
+                dtype = torch.float16 if self.half else torch.float32
+                for shape in self._warmup_shapes(img_size):
+                    resolution(torch.zeros(shape, device=self.device, dtype=dtype))
+
+            self._resolutions[img_size] = resolution
+            while len(self._resolutions) > max(self.resolution_cache, 1):
+                _, evicted = self._resolutions.popitem(last=False)
+                if evicted.preprocessor is not self.preprocessor:
+                    evicted.preprocessor.clear()
+            return resolution
+
+    @property
+    def _dynamic_shapes(self):
+        # False for ONNX graphs exported with a fixed input size, the letterbox then always pads to a square
+        return self.backend != 'onnxruntime' or self.model.dynamic
+
+    def _warmup_shapes(self, img_size):
+        # input shapes run once when a resolution is prepared. Compiled models build separate graphs for batch 1,
+        # larger batches and, with an auto letterbox, rectangles of other sizes, all of them are compiled here rather
+        # than on the first such batch.
+        if self.backend != 'compile':
+            return [(1, 3, img_size, img_size)]
+        sizes = [(img_size, img_size)]
+        if self.same_size or self.bucket_shapes:
+            sizes.append((max(img_size - self.model_stride, self.model_stride),
+                          max(img_size - 2 * self.model_stride, self.model_stride)))
+        return [(bs, 3, h, w) for bs in ((1, 2) if self.max_batch_size > 1 else (1,)) for h, w in sizes]
+
+    def _iter_batches(self, images, preprocessor):
+        # chunk any iterable of frames into (indices, frames) batches of at most max_batch_size without materialising
+        # it. With bucket_shapes, frames are grouped by letterboxed shape within windows of bucket_window frames.
+        images = enumerate(images)
+        window = max(self.bucket_window, self.max_batch_size) if self.bucket_shapes else self.max_batch_size
+        while True:
+            chunk = list(islice(images, window))
+            if not chunk:
+                return
+            if not all(isinstance(im, np.ndarray) for _, im in chunk):
+                raise AssertionError('all images must be np arrays')
+
+            if self.bucket_shapes:
+                buckets = {}
+                for i, im in chunk:
+                    buckets.setdefault(preprocessor.input_shape(im), []).append((i, im))
+                groups = buckets.values()
+            else:
+                groups = [chunk]
+            for group in groups:
+                for j in range(0, len(group), self.max_batch_size):
+                    indices, batch = zip(*group[j:j + self.max_batch_size])
+                    yield indices, list(batch)
+
+    def _preprocess_batch(self, indexed, resolution):
+        indices, batch = indexed
+        with self._device_context():
+            return indices, batch, resolution.preprocessor.load(batch)
+
+    @torch.no_grad()
+    def _forward_batch(self, loaded, resolution):
+        indices, batch, slot = loaded
+        try:
+            with self._device_context():
+                features = resolution(slot.input)[0]
+        finally:
+            resolution.preprocessor.release(slot)
+        return indices, batch, features, slot.shape
+
+    @torch.no_grad()
+    def _suppress(self, preds, input_shape, frame_shapes, classes=None):
+        # NMS and rescaling on the model device, only the surviving (n,6) [xyxy, conf, cls] rows come back to host
+        class_idxs = [self._head_class_idx(name) for name in classes] if classes is not None else None
+        with self._device_context():
+            dets, counts = batched_non_max_suppression(preds, self.conf_thresh, self.nms_thresh, classes=class_idxs,
+                                                       class_subset=self._head_class_map is not None,
+                                                       max_det=self.max_det, max_nms=self.max_nms,
+                                                       engine=self.nms_engine, flat=True)
+            dets = dets.float()  # rescale fp16 predictions in fp32, frame coordinates exceed fp16 precision
+            image_ids = torch.repeat_interleave(torch.arange(len(counts), device=counts.device), counts)
+            dets[:, :4] = scale_coords_batch(input_shape[1:], dets[:, :4], frame_shapes, image_ids).round()
+            if self._head_class_map is not None:  # back to class_names indices
+                dets[:, 5] = self._head_class_map[dets[:, 5].long()]
+            return dets.cpu(), counts.tolist()
+
+    def _postprocess_batch(self, predicted, box_format='ltrb', classes=None, buffer_ratio=0.0, arrays=False):
+        indices, batch, preds, input_shape = predicted
+        frame_shapes = [image.shape for image in batch]
+        dets, counts = self._suppress(preds, input_shape, frame_shapes, classes=classes)
+        del preds  # raw head output is dropped as soon as the batch is suppressed
+        detections = self._postprocess(dets, counts, frame_shapes=frame_shapes, box_format=box_format,
+                                       buffer_ratio=buffer_ratio)
+        if not arrays:
+            detections = [self._as_tuples(*frame_dets) for frame_dets in detections]
+        return indices, detections
+
+    def detect_iter(self, images, box_format='ltrb', classes=None, buffer_ratio=0.0, arrays=False, img_size=None):
+        '''
+        Streaming version of detect_get_box_in. Frames are preprocessed, inferred, suppressed and postprocessed
+        max_batch_size at a time, so peak memory is bounded by the batch size rather than the number of frames.
+        With pipeline=True the three stages run in their own threads, so the next batch is letterboxed and the
+        previous one suppressed while the current batch is in the forward pass. With bucket_shapes=True frames of
+        mixed resolution are batched by their minimum-rectangle input shape and results are put back in input order.
+
+        Parameters
+        ----------
+        images : Iterable[ndarray]
+            iterable of ndarray-like images, e.g. a list or a generator reading frames from a video
+        box_format : str, optional
+            string of characters representing format order, where l = left, t = top, r = right, b = bottom, w = width and h = height
+        classes : List[str], optional
+            classes to focus on, not the same as YOLOv7(classes=...), see detect_get_box_in
+        buffer_ratio : float, optional
+            proportion of buffer around the width and height of the bounding box
+        arrays : bool, optional
+            yield (boxes, scores, class_ids) arrays instead of tuples, see detect_get_box_in
+        img_size : int, optional
+            inference size for this call instead of model_image_size, see resolution_cache
 
-        predictions = torch.cat(preds, dim=0)
+        Yields
+        ------
+        List of tuple (box_infos, score, predicted_class) for each image, in input order. See detect_get_box_in.
+        '''
+        if any(c not in [*'tlbrwh'] for c in box_format):
+            raise AssertionError('box_format given is unrecognised!')
 
-        return predictions, input_shapes
+        postprocess = partial(self._postprocess_batch, box_format=box_format, classes=classes, buffer_ratio=buffer_ratio,
+                              arrays=arrays)
+        resolution = self._resolution(img_size)
+        preprocess = partial(self._preprocess_batch, resolution=resolution)
+        forward = partial(self._forward_batch, resolution=resolution)
+        batches = self._iter_batches(images, resolution.preprocessor)
+        if self.pipeline:
+            results = pipelined(batches, preprocess, forward, postprocess, depth=self.pipeline_depth)
+        else:
+            results = (postprocess(forward(preprocess(batch))) for batch in batches)
 
-    def _batch_pred(self, batches):
-        preds = []
-        for batch in batches:
-            batch = batch.to(self.device)
-            features = self.model(batch)[0]
-            preds.append(features.detach().cpu())
-            del features
-        return preds
+        pending, next_index = {}, 0  # bucketed batches can complete out of input order
+        for indices, dets in results:
+            pending.update(zip(indices, dets))
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
 
-    def detect_get_box_in(self, images, box_format='ltrb', classes=None, buffer_ratio=0.0):
+    def detect_get_box_in(self, images, box_format='ltrb', classes=None, buffer_ratio=0.0, arrays=False, img_size=None):
         '''
         Parameters
         ----------
@@ -114,11 +363,16 @@ class YOLOv7:
         box_format : str, optional
             string of characters representing format order, where l = left, t = top, r = right, b = bottom, w = width and h = height
         classes : List[str], optional
-            classes to focus on
+            classes to focus on, detections of other classes are dropped after NMS. This differs from
+            YOLOv7(classes=...), which builds the head for a subset: each box then takes its best class among the
+            subset only, so a box whose best class overall is outside it is reported under its best subset class,
+            with that lower score, instead of being dropped. Expect more detections from a subset head.
         buffer_ratio : float, optional
             proportion of buffer around the width and height of the bounding box
-        raw : bool, optional
-            return raw inferences instead of detections after postprocessing
+        arrays : bool, optional
+            return (boxes, scores, class_ids) arrays per image instead of a list of tuples
+        img_size : int, optional
+            inference size for this call instead of model_image_size, see resolution_cache
         
         Returns
         ------
@@ -129,6 +383,11 @@ class YOLOv7:
         score : float
             confidence level of prediction
         predicted_class : string
+        With arrays=True each image gives a tuple (boxes, scores, class_ids) instead.
+        boxes : ndarray(n, len(box_format)) int64
+        scores : ndarray(n,) float32
+        class_ids : ndarray(n,) int64
+            index into class_names
         '''
         single = False
         if isinstance(images, list):
@@ -141,29 +400,26 @@ class YOLOv7:
             images = [images]
             single = True
 
-        if any(c not in [*'tlbrwh'] for c in box_format):
-            raise AssertionError('box_format given is unrecognised!')
-
-        res, input_shapes = self._detect(images)
-        frame_shapes = [image.shape for image in images]
-
-        all_dets = self._postprocess(res, input_shapes=input_shapes, frame_shapes=frame_shapes, box_format=box_format, classes=classes, buffer_ratio=buffer_ratio)
+        all_dets = list(self.detect_iter(images, box_format=box_format, classes=classes, buffer_ratio=buffer_ratio,
+                                         arrays=arrays, img_size=img_size))
 
         if single:
             return all_dets[0]
         else:
             return all_dets
 
-    def get_detections_dict(self, frames, classes=None, buffer_ratio=0.0):
+    def get_detections_dict(self, frames, classes=None, buffer_ratio=0.0, img_size=None):
         '''
         Parameters
         ----------
         frames : List[ndarray]
             list of input images
         classes : List[str], optional
-            classes to focus on
+            classes to focus on, not the same as YOLOv7(classes=...), see detect_get_box_in
         buffer_ratio : float, optional
             proportion of buffer around the width and height of the bounding box
+        img_size : int, optional
+            inference size for this call instead of model_image_size, see resolution_cache
 
         Returns
         -------
@@ -173,64 +429,222 @@ class YOLOv7:
 
         if frames is None or len(frames) == 0:
             return None
-        all_dets = self.detect_get_box_in(frames, box_format='tlbrwh', classes=classes, buffer_ratio=buffer_ratio)
-        
-        all_detections = []
-        for dets in all_dets:
-            detections = []
-            for tlbrwh, confidence, label in dets:
-                top, left, bot, right, width, height = tlbrwh
-                detections.append({'label': label, 'confidence': confidence, 't': top, 'l': left, 'b': bot, 'r': right, 'w': width, 'h': height})
-            all_detections.append(detections)
-        return all_detections
-
-    def _postprocess(self, boxes, input_shapes, frame_shapes, box_format='ltrb', classes=None, buffer_ratio=0.0):
-        class_idxs = [self.classname_to_idx(name) for name in classes] if classes is not None else None
-        preds = non_max_suppression(boxes, self.conf_thresh, self.nms_thresh, classes=class_idxs)
-
-        detections = []
-        for i, frame_bbs in enumerate(preds):
-            if frame_bbs is None:
-                detections.append([])
-                continue
-
-            im_height, im_width, _ = frame_shapes[i]
-            
-            # Rescale preds from input size to frame size
-            frame_bbs[:, :4] = scale_coords(input_shapes[i][1:], frame_bbs[:, :4], frame_shapes[i]).round()
-
-            frame_dets = []
-            for *xyxy, cls_conf, cls_id in frame_bbs:
-                cls_conf = float(cls_conf)
-                cls_name = self.class_names[int(cls_id)]
-
-                left = int(xyxy[0])
-                top = int(xyxy[1])
-                right = int(xyxy[2])
-                bottom = int(xyxy[3])
-                
-                width = right - left + 1
-                height = bottom - top + 1
-                width_buffer = width * buffer_ratio
-                height_buffer = height * buffer_ratio
-
-                top = max(0.0, top - 0.5*height_buffer)
-                left = max(0.0, left - 0.5*width_buffer)
-                bottom = min(im_height - 1.0, bottom + 0.5*height_buffer)
-                right = min(im_width - 1.0, right + 0.5*width_buffer)
-
-                box_attr = {'t': int(round(top)),
-                            'l': int(round(left)),
-                            'b': int(round(bottom)),
-                            'r': int(round(right)),
-                            'w': int(round(width+width_buffer)),
-                            'h': int(round(height+height_buffer))}
-                box_infos = [box_attr[c] for c in box_format]
-                if not len(box_infos) > 0:
-                    raise AssertionError('box infos is blank')
-
-                detection = (box_infos, cls_conf, cls_name)
-                frame_dets.append(detection)
-            detections.append(frame_dets)
-
-        return detections
+        return self.detect_batch(frames, box_format='tlbrwh', classes=classes, buffer_ratio=buffer_ratio,
+                                 img_size=img_size).to_dicts()
+
+    def detect_batch(self, images, box_format='ltrb', classes=None, buffer_ratio=0.0, img_size=None):
+        '''
+        Columnar version of detect_get_box_in, the detections of all images are kept in contiguous arrays.
+
+        Parameters
+        ----------
+        images : List[ndarray]
+            list of input images
+        box_format : str, optional
+            string of characters representing format order, where l = left, t = top, r = right, b = bottom, w = width and h = height
+        classes : List[str], optional
+            classes to focus on, not the same as YOLOv7(classes=...), see detect_get_box_in
+        buffer_ratio : float, optional
+            proportion of buffer around the width and height of the bounding box
+        img_size : int, optional
+            inference size for this call instead of model_image_size, see resolution_cache
+
+        Returns
+        -------
+        DetectionBatch
+            boxes, scores, class_ids and per image offsets, batch[i] gives (boxes, scores, class_ids) views of image i
+            and to_tuples() / to_dicts() the detect_get_box_in / get_detections_dict formats
+        '''
+        if not box_format:
+            raise AssertionError('box infos is blank')
+        frames = self.detect_iter(images, box_format=box_format, classes=classes, buffer_ratio=buffer_ratio,
+                                  arrays=True, img_size=img_size)
+        return DetectionBatch.from_frames(frames, box_format=box_format, class_names=self.class_names)
+
+    async def detect_async(self, images, box_format='ltrb', classes=None, buffer_ratio=0.0, arrays=False,
+                           img_size=None):
+        '''
+        Coroutine version of detect_get_box_in for asyncio callers. Preprocessing, inference and NMS run on a
+        dedicated executor of async_workers threads, max_batch_size frames per executor call, so the event loop is
+        never blocked and a cancelled call stops after its current batch. At most async_max_in_flight calls run at
+        once, further callers wait on the event loop.
+
+        Parameters and return value are the same as detect_get_box_in.
+        '''
+        single = isinstance(images, np.ndarray)
+        if single:
+            images = [images]
+        elif isinstance(images, list) and len(images) <= 0:
+            return None
+
+        loop = asyncio.get_running_loop()
+        limit = self._async_limits.get(loop)
+        if limit is None:
+            limit = self._async_limits[loop] = asyncio.Semaphore(self.async_max_in_flight)
+
+        async with limit:
+            executor = self._get_async_executor()
+            results = self.detect_iter(images, box_format=box_format, classes=classes, buffer_ratio=buffer_ratio,
+                                       arrays=arrays, img_size=img_size)
+            all_dets, future = [], None
+            try:
+                while True:
+                    future = executor.submit(lambda: list(islice(results, self.max_batch_size)))
+                    dets = await asyncio.wrap_future(future)
+                    if not dets:
+                        break
+                    all_dets.extend(dets)
+            finally:
+                # a cancelled call may leave its batch running, close the generator once that batch returns
+                if future is not None:
+                    future.add_done_callback(lambda _: results.close())
+
+        return all_dets[0] if single else all_dets
+
+    async def get_detections_dict_async(self, frames, classes=None, buffer_ratio=0.0, img_size=None):
+        '''
+        Coroutine version of get_detections_dict, see detect_async.
+        '''
+        if frames is None or len(frames) == 0:
+            return None
+        all_dets = await self.detect_async(frames, box_format='tlbrwh', classes=classes, buffer_ratio=buffer_ratio,
+                                           arrays=True, img_size=img_size)
+        return DetectionBatch.from_frames(all_dets, box_format='tlbrwh', class_names=self.class_names).to_dicts()
+
+    def _get_async_executor(self):
+        if self._async_executor is None:
+            with self._batcher_lock:
+                if self._async_executor is None:
+                    self._async_executor = ThreadPoolExecutor(self.async_workers, thread_name_prefix='yolov7-async')
+        return self._async_executor
+
+    def submit(self, image, box_format='ltrb', classes=None, buffer_ratio=0.0, img_size=None):
+        '''
+        Queue one image for detection. Concurrent submissions are collected by a background thread into batches
+        of up to max_batch_size, or whatever has arrived batch_wait_ms after the first one, and run together.
+
+        Parameters
+        ----------
+        image : ndarray
+            input image
+        box_format, classes, buffer_ratio, img_size :
+            see detect_get_box_in, only requests with the same values are batched together
+
+        Returns
+        -------
+        concurrent.futures.Future
+            resolves to the list of tuple (box_infos, score, predicted_class) for the image
+        '''
+        if not isinstance(image, np.ndarray):
+            raise AssertionError('image must be a np array')
+        if self._batcher is None:
+            with self._batcher_lock:
+                if self._batcher is None:
+                    self._batcher = MicroBatcher(self._detect_batched, max_batch_size=self.max_batch_size,
+                                                 max_wait=self.batch_wait_ms / 1000)
+        key = (box_format, tuple(classes) if classes is not None else None, buffer_ratio, img_size)
+        return self._batcher.submit(image, key=key)
+
+    def _detect_batched(self, key, images):
+        box_format, classes, buffer_ratio, img_size = key
+        return self.detect_get_box_in(images, box_format=box_format, classes=classes, buffer_ratio=buffer_ratio,
+                                      img_size=img_size)
+
+    def close(self):
+        # stop the submit() batcher and async executor after they drain, release worker threads and input buffers
+        with self._batcher_lock:
+            if self._batcher is not None:
+                self._batcher.close()
+                self._batcher = None
+            if self._async_executor is not None:
+                self._async_executor.shutdown()
+                self._async_executor = None
+        if self._ensemble_pool is not None:
+            self._ensemble_pool.shutdown()
+        self.preprocessor.close()
+
+    def _postprocess(self, dets, counts, frame_shapes, box_format='ltrb', buffer_ratio=0.0):
+        # Buffer expansion, clamping, rounding and box_format column selection on the whole (n,6) block of a batch
+        # at once. Returns (boxes, scores, class_ids) arrays per image.
+        if len(dets) and not box_format:
+            raise AssertionError('box infos is blank')
+        dets = dets.float().numpy()
+        frame_hw = np.array([shape[:2] for shape in frame_shapes], dtype=np.float64).reshape(-1, 2)
+        im_height, im_width = np.repeat(frame_hw, counts, axis=0).T  # per detection
+
+        left, top, right, bottom = dets[:, :4].astype(np.int64).T  # already rounded
+
+        width = right - left + 1
+        height = bottom - top + 1
+        width_buffer = width * buffer_ratio
+        height_buffer = height * buffer_ratio
+
+        box_attr = {'t': np.maximum(0.0, top - 0.5*height_buffer),
+                    'l': np.maximum(0.0, left - 0.5*width_buffer),
+                    'b': np.minimum(im_height - 1.0, bottom + 0.5*height_buffer),
+                    'r': np.minimum(im_width - 1.0, right + 0.5*width_buffer),
+                    'w': width + width_buffer,
+                    'h': height + height_buffer}
+        columns = [box_attr[c] for c in box_format]
+        boxes = np.rint(np.stack(columns, axis=1)).astype(np.int64) if columns else np.empty((len(dets), 0), np.int64)
+        scores = dets[:, 4]
+        class_ids = dets[:, 5].astype(np.int64)
+
+        splits = np.cumsum(counts)[:-1]
+        return list(zip(np.split(boxes, splits), np.split(scores, splits), np.split(class_ids, splits)))
+
+    def _as_tuples(self, boxes, scores, class_ids):
+        # per image arrays to the list of (box_infos, score, predicted_class) tuples
+        class_names = self.class_names
+        return [(box_infos, score, class_names[cls_id])
+                for box_infos, score, cls_id in zip(boxes.tolist(), scores.tolist(), class_ids.tolist())]
+
+
+class _Resolution:
+    # Prepared state of one inference size, see YOLOv7._resolution()
+    __slots__ = ('img_size', 'preprocessor', 'members', 'pool', 'streams')
+
+    def __init__(self, img_size, pool=None, streams=None):
+        self.img_size = img_size
+        self.preprocessor = None  # Preprocessor letterboxing to img_size
+        self.members = []  # (backbone, detect) per model, traced or eager model up to Detect() and its Detect(), or
+                           # (OnnxModel, None)
+        self.pool = pool  # threads running the ensemble members besides the first
+        self.streams = streams  # CUDA stream per ensemble member
+
+    def __call__(self, x):
+        if len(self.members) == 1:
+            return self._forward(*self.members[0], x)
+
+        # ensemble: members run concurrently on the same input, their predictions are concatenated for one NMS
+        if self.streams is not None:
+            current = torch.cuda.current_stream(x.device)
+            for stream in self.streams:
+                stream.wait_stream(current)  # input is ready
+        futures = [self.pool.submit(self._run, i, x) for i in range(1, len(self.members))]
+        outputs = [self._run(0, x)] + [future.result() for future in futures]
+        if self.streams is not None:
+            for stream in self.streams:
+                current.wait_stream(stream)
+            for output in outputs:
+                for t in output if isinstance(output, tuple) else (output,):
+                    if isinstance(t, torch.Tensor):
+                        t.record_stream(current)  # allocated on a member stream, used on this one
+
+        if isinstance(outputs[0], tuple):  # sparse candidates
+            rows, image_ids, bs = zip(*outputs)
+            return (torch.cat(rows), torch.cat(image_ids), bs[0]), None
+        return torch.cat(outputs, 1), None
+
+    @torch.no_grad()  # grad mode is per thread
+    def _run(self, i, x):
+        if self.streams is None:
+            return self._forward(*self.members[i], x)[0]
+        with torch.cuda.stream(self.streams[i]):
+            x.record_stream(self.streams[i])
+            return self._forward(*self.members[i], x)[0]
+
+    @staticmethod
+    def _forward(backbone, detect, x):
+        out = backbone(x)
+        return detect(out) if detect is not None else out